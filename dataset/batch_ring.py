@@ -0,0 +1,88 @@
+import numpy as np
+import multiprocessing as mp
+from collections import namedtuple
+from queue import Queue
+
+# queued in place of a result that lives in ring slot `slot`, `index` is its position in the batch's result list
+SlotRef = namedtuple('SlotRef', ['slot', 'index'])
+
+
+def get_slot_spec(res_list):
+    # (kind, [(shape, dtype), ...]) for every result, kind is None for a plain array or the namedtuple/tuple type
+    spec = []
+    for res in res_list:
+        if isinstance(res, tuple):
+            spec.append((type(res), [(np.shape(arr), np.asarray(arr).dtype) for arr in res]))
+        else:
+            spec.append((None, [(np.shape(res), np.asarray(res).dtype)]))
+    return spec
+
+
+class BatchRing(object):
+    # fixed set of num_slots preallocated batch slots, one slot holds all results of one batch.
+    # the producer acquires a free slot, writes into it and queues SlotRefs; a slot goes back to the free
+    # list once every result in it was released. memory stays bounded by num_slots whatever the consumer does.
+    # with shared=True the slots live in shared memory, so forked workers write batches in place and only
+    # the slot id travels back; the ring must then be created before forking.
+    # results must have the fixed shapes of spec (see get_slot_spec), which holds for aligned batches.
+    def __init__(self, num_slots, spec, shared=False):
+        assert num_slots >= 2, "the consumer holds one slot while the producer fills another"
+        self.num_slots = num_slots
+        self.spec = spec
+        self.shared = shared
+        self.slots = [[self._allocate(fields) for _, fields in spec] for _ in range(num_slots)]
+        self.refs = [0] * num_slots
+        self.free = Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+
+    def _allocate(self, fields):
+        arrays = []
+        for shape, dtype in fields:
+            if self.shared:
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                buffer = mp.RawArray('b', max(nbytes, 1))
+                arrays.append(np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape))
+            else:
+                arrays.append(np.empty(shape, dtype=dtype))
+        return arrays
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for slot in self.slots for arrays in slot for arr in arrays)
+
+    def acquire(self, timeout=None):
+        # raises queue.Empty when no slot frees up within timeout, timeout=0 does not block
+        if timeout == 0:
+            slot = self.free.get_nowait()
+        else:
+            slot = self.free.get(timeout=timeout)
+        self.refs[slot] = len(self.spec)
+        return slot
+
+    def write(self, slot, res_list):
+        for arrays, (kind, fields), res in zip(self.slots[slot], self.spec, res_list):
+            values = res if kind is not None else (res,)
+            for arr, (shape, _), value in zip(arrays, fields, values):
+                if np.shape(value) != shape:
+                    raise ValueError("result of shape {} does not fit a ring slot of shape {}".format(np.shape(value), shape))
+                arr[...] = value
+
+    def read(self, ref):
+        # a view into the slot, valid until the ref is released
+        arrays = self.slots[ref.slot][ref.index]
+        kind = self.spec[ref.index][0]
+        if kind is None:
+            return arrays[0]
+        if kind is tuple:
+            return tuple(arrays)
+        return kind(*arrays)
+
+    def refs_of(self, slot):
+        return [SlotRef(slot, index) for index in range(len(self.spec))]
+
+    def release(self, ref):
+        self.refs[ref.slot] -= 1
+        if self.refs[ref.slot] == 0:
+            self.free.put(ref.slot)
+
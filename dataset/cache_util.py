@@ -0,0 +1,298 @@
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+from collections import OrderedDict, defaultdict
+
+from mesh_util import MeshView
+
+
+def get_nbytes(value):
+    # private memory held by a cached value; memory-mapped arrays live in the page cache and count as free
+    if isinstance(value, np.ndarray):
+        return 0 if isinstance(value, np.memmap) else value.nbytes
+    nbytes = 0
+    for name in ('vertices', 'faces'):
+        arr = getattr(value, name, None)
+        if isinstance(arr, np.ndarray) and not isinstance(arr, np.memmap):
+            nbytes += arr.nbytes
+    return nbytes
+
+
+class MeshCache(object):
+    # maxsize bounds the number of entries, maxbytes the memory of the entries, None means unbounded
+    def __init__(self, maxsize=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        raise NotImplementedError
+
+    def _insert(self, key, value, nbytes):
+        raise NotImplementedError
+
+    def _pop_victim(self):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def clear(self):
+        self.nbytes = 0
+
+    def get(self, key, default=None):
+        if key in self:
+            self.hits += 1
+            return self._lookup(key)
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        nbytes = get_nbytes(value)
+        if key in self or (self.maxbytes is not None and nbytes > self.maxbytes) or self.maxsize == 0:
+            return
+        # make room first, so that the new entry is never its own victim
+        while (self.maxsize is not None and len(self) + 1 > self.maxsize) or \
+                (self.maxbytes is not None and self.nbytes + nbytes > self.maxbytes):
+            self.nbytes -= self._pop_victim()
+            self.evictions += 1
+        self._insert(key, value, nbytes)
+        self.nbytes += nbytes
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self), 'nbytes': self.nbytes}
+
+
+class LRUCache(MeshCache):
+    def __init__(self, maxsize=None, maxbytes=None):
+        super(LRUCache, self).__init__(maxsize, maxbytes)
+        self.entries = OrderedDict()
+
+    def _lookup(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def _insert(self, key, value, nbytes):
+        self.entries[key] = (value, nbytes)
+
+    def _pop_victim(self):
+        _, (_, nbytes) = self.entries.popitem(last=False)
+        return nbytes
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        super(LRUCache, self).clear()
+        self.entries.clear()
+
+
+class LFUCache(MeshCache):
+    # evicts the least frequently used entry, ties broken by recency
+    def __init__(self, maxsize=None, maxbytes=None):
+        super(LFUCache, self).__init__(maxsize, maxbytes)
+        self.entries = {}
+        self.buckets = defaultdict(OrderedDict)
+        self.min_freq = 0
+
+    def _lookup(self, key):
+        value, nbytes, freq = self.entries[key]
+        del self.buckets[freq][key]
+        if len(self.buckets[freq]) == 0:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = freq + 1
+        self.buckets[freq + 1][key] = None
+        self.entries[key] = (value, nbytes, freq + 1)
+        return value
+
+    def _insert(self, key, value, nbytes):
+        self.entries[key] = (value, nbytes, 1)
+        self.buckets[1][key] = None
+        self.min_freq = 1
+
+    def _pop_victim(self):
+        bucket = self.buckets[self.min_freq]
+        key, _ = bucket.popitem(last=False)
+        if len(bucket) == 0:
+            del self.buckets[self.min_freq]
+            self.min_freq = min(self.buckets) if self.buckets else 0
+        _, nbytes, _ = self.entries.pop(key)
+        return nbytes
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        super(LFUCache, self).clear()
+        self.entries.clear()
+        self.buckets.clear()
+        self.min_freq = 0
+
+
+# default byte budget of a shared cache namespace, capped at a quarter of the filesystem holding it
+SHARED_CACHE_MAXBYTES = 4 * 1024 ** 3
+# namespaces (and leftover temporary entries) untouched for this long are removed when a cache is opened
+SHARED_CACHE_MAX_AGE = 7 * 24 * 3600
+
+
+class SharedMeshCache(MeshCache):
+    # node-wide cache shared by every process using the same root, defaults to tmpfs.
+    # each entry is a directory holding vertices.npy/faces.npy, published with an atomic rename, so
+    # readers never see partial entries. hits are memory-mapped; an evicted entry stays readable by
+    # processes that already mapped it. eviction drops the least recently used entries (by mtime)
+    # once the whole root exceeds maxbytes or holds more than maxsize entries.
+    # namespace separates datasets whose ids would collide, e.g. different meta builds.
+    # maxbytes=None uses SHARED_CACHE_MAXBYTES. a namespace counts as in use while a process has it open; opening
+    # a cache removes the namespaces nobody used for max_age seconds and trims its own namespace to the budget
+    def __init__(self, maxsize=None, maxbytes=None, root=None, namespace='default', max_age=SHARED_CACHE_MAX_AGE):
+        if root is None:
+            root = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else '/tmp', 'partnet_mesh_cache')
+        os.makedirs(root, exist_ok=True)
+        if maxbytes is None:
+            stat = os.statvfs(root)
+            maxbytes = min(SHARED_CACHE_MAXBYTES, stat.f_blocks * stat.f_frsize // 4)
+        super(SharedMeshCache, self).__init__(maxsize, maxbytes)
+        self.base_root = root
+        self.root = os.path.join(root, namespace)
+        self.max_age = max_age
+        os.makedirs(self.root, exist_ok=True)
+        self.put_count = 0
+        self.put_nbytes = 0
+        self._touch()
+        self._remove_stale()
+        self._evict()
+
+    def _touch(self):
+        # marks the namespace as in use, the mtime of the directory is what _remove_stale looks at
+        self.touched = time.time()
+        os.utime(self.root)
+
+    def _remove_stale(self):
+        deadline = time.time() - self.max_age
+        stale = []
+        for entry in os.scandir(self.base_root):
+            if entry.path != self.root and entry.is_dir() and entry.stat().st_mtime < deadline:
+                stale.append(entry.path)
+        for entry in os.scandir(self.root):
+            # temporary and evicted leftovers of crashed processes
+            if '.' in entry.name and entry.stat().st_mtime < deadline:
+                stale.append(entry.path)
+        for path in stale:
+            # renamed first, so a process opening the namespace right now recreates it instead of half-deleting
+            victim = os.path.join(os.path.dirname(path), '.evicted-' + uuid.uuid4().hex)
+            try:
+                os.rename(path, victim)
+            except OSError:
+                continue
+            shutil.rmtree(victim, ignore_errors=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, '_'.join(str(k) for k in key))
+
+    def __contains__(self, key):
+        return os.path.isdir(self._path(key))
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.root) if '.' not in name])
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            vertices = np.load(os.path.join(path, 'vertices.npy'), mmap_mode='r')
+            faces = np.load(os.path.join(path, 'faces.npy'), mmap_mode='r')
+            os.utime(path)
+            if time.time() - self.touched > 600:
+                self._touch()
+        except (FileNotFoundError, ValueError):
+            # missing, or evicted by another process while we were reading it
+            self.misses += 1
+            return default
+        self.hits += 1
+        return MeshView(vertices, faces)
+
+    def put(self, key, value):
+        path = self._path(key)
+        if os.path.isdir(path):
+            return
+        tmp_path = os.path.join(self.root, '.tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        if isinstance(value, np.ndarray):
+            vertices, faces = value, np.zeros((0, 3), dtype=np.int32)
+        else:
+            vertices, faces = value.vertices, value.faces
+        np.save(os.path.join(tmp_path, 'vertices.npy'), np.asarray(vertices))
+        np.save(os.path.join(tmp_path, 'faces.npy'), np.asarray(faces))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process published the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        # only rescan the root after this process wrote a sizeable share of the budget
+        self.put_count += 1
+        self.put_nbytes += np.asarray(vertices).nbytes + np.asarray(faces).nbytes
+        if (self.maxbytes is not None and self.put_nbytes > self.maxbytes // 16) or \
+                (self.maxsize is not None and self.put_count > self.maxsize // 16):
+            self.put_count = 0
+            self.put_nbytes = 0
+            self._evict()
+
+    def _evict(self):
+        self._touch()
+        entries = []
+        for entry in os.scandir(self.root):
+            if '.' in entry.name:
+                continue
+            try:
+                nbytes = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, nbytes, entry.path))
+            except FileNotFoundError:
+                continue
+        self.nbytes = sum(nbytes for _, nbytes, _ in entries)
+        count = len(entries)
+        entries.sort()
+        for _, nbytes, path in entries:
+            if (self.maxbytes is None or self.nbytes <= self.maxbytes) and (self.maxsize is None or count <= self.maxsize):
+                break
+            victim = path + '.evicted-' + uuid.uuid4().hex
+            try:
+                os.rename(path, victim)
+            except OSError:
+                continue
+            shutil.rmtree(victim, ignore_errors=True)
+            self.nbytes -= nbytes
+            count -= 1
+            self.evictions += 1
+
+    def clear(self):
+        # entries belong to every process on the node, only the local accounting is reset
+        super(SharedMeshCache, self).clear()
+        self.put_count = 0
+        self.put_nbytes = 0
+
+
+CACHE_POLICIES = {
+    'lru': LRUCache,
+    'lfu': LFUCache,
+    'shared': SharedMeshCache,
+}
+
+
+def make_cache(policy='lru', maxsize=None, maxbytes=None, **kwargs):
+    return CACHE_POLICIES[policy](maxsize=maxsize, maxbytes=maxbytes, **kwargs)
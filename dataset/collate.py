@@ -0,0 +1,114 @@
+import numpy as np
+from collections import namedtuple
+
+PaddedBatch = namedtuple('PaddedBatch', ['data', 'lengths', 'mask'])
+RaggedBatch = namedtuple('RaggedBatch', ['data', 'offsets'])
+RaggedMeshBatch = namedtuple('RaggedMeshBatch', ['vertices', 'vertex_offsets', 'faces', 'face_offsets'])
+
+
+class Collator(object):
+    # turns the list of samples of a batch into one batch.
+    # with num_buffers set, outputs are written into num_buffers preallocated buffers used in turn, so the
+    # steady state allocates nothing; a batch then stays valid until num_buffers further batches were collated.
+    # buffers only grow (geometrically), None allocates fresh arrays for every batch.
+    def __init__(self, num_buffers=None):
+        self.num_buffers = num_buffers
+        self.slots = [{} for _ in range(num_buffers or 0)]
+        self.current = 0
+        self.slot = None
+
+    def _next_slot(self):
+        if self.num_buffers is None:
+            self.slot = {}
+        else:
+            self.slot = self.slots[self.current]
+            self.current = (self.current + 1) % self.num_buffers
+
+    def _buffer(self, name, shape, dtype):
+        # view of shape `shape` into the named buffer of the current slot
+        buffer = self.slot.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.ndim != len(shape) or \
+                any(have < need for have, need in zip(buffer.shape, shape)):
+            if buffer is None or buffer.dtype != dtype or buffer.ndim != len(shape):
+                capacity = tuple(shape)
+            else:
+                capacity = tuple(max(have, need if need <= have else 2 * need)
+                                 for have, need in zip(buffer.shape, shape))
+            buffer = np.empty(capacity, dtype=dtype)
+            self.slot[name] = buffer
+        return buffer[tuple(slice(0, n) for n in shape)]
+
+    def __call__(self, batch):
+        raise NotImplementedError
+
+
+class StackCollator(Collator):
+    # equal-sized samples, like np.stack
+    def __call__(self, batch):
+        self._next_slot()
+        first = np.asarray(batch[0])
+        res = self._buffer('data', (len(batch),) + first.shape, first.dtype)
+        for i, sample in enumerate(batch):
+            res[i] = sample
+        return res
+
+
+class PaddedCollator(Collator):
+    # (B, L, C) data padded with pad_value, lengths (B,) and a validity mask (B, L);
+    # L is max_len when given (longer samples are truncated), otherwise the longest sample of the batch
+    def __init__(self, max_len=None, pad_value=0, num_buffers=None):
+        super(PaddedCollator, self).__init__(num_buffers)
+        self.max_len = max_len
+        self.pad_value = pad_value
+
+    def __call__(self, batch):
+        self._next_slot()
+        lengths_list = [len(sample) for sample in batch]
+        max_len = self.max_len if self.max_len is not None else max(lengths_list)
+        first = np.asarray(batch[0])
+        data = self._buffer('data', (len(batch), max_len) + first.shape[1:], first.dtype)
+        lengths = self._buffer('lengths', (len(batch),), np.int64)
+        mask = self._buffer('mask', (len(batch), max_len), np.bool_)
+        data[...] = self.pad_value
+        for i, sample in enumerate(batch):
+            length = min(lengths_list[i], max_len)
+            data[i, :length] = sample[:length]
+            lengths[i] = length
+        np.less(np.arange(max_len), lengths[:, None], out=mask)
+        return PaddedBatch(data, lengths, mask)
+
+
+class RaggedCollator(Collator):
+    # samples concatenated along the first axis, sample i is data[offsets[i]:offsets[i + 1]]
+    def __call__(self, batch):
+        self._next_slot()
+        lengths = [len(sample) for sample in batch]
+        first = np.asarray(batch[0])
+        data = self._buffer('data', (sum(lengths),) + first.shape[1:], first.dtype)
+        offsets = self._buffer('offsets', (len(batch) + 1,), np.int64)
+        offsets[0] = 0
+        np.cumsum(lengths, out=offsets[1:])
+        for i, sample in enumerate(batch):
+            data[offsets[i]:offsets[i + 1]] = sample
+        return RaggedBatch(data, offsets)
+
+
+class RaggedMeshCollator(Collator):
+    # meshes (anything with vertices and faces) packed into one vertex and one face array;
+    # faces are shifted to index the packed vertices
+    def __call__(self, batch):
+        self._next_slot()
+        vert_counts = [len(mesh.vertices) for mesh in batch]
+        face_counts = [len(mesh.faces) for mesh in batch]
+        vertices = self._buffer('vertices', (sum(vert_counts), 3), np.asarray(batch[0].vertices).dtype)
+        faces = self._buffer('faces', (sum(face_counts), 3), np.asarray(batch[0].faces).dtype)
+        vertex_offsets = self._buffer('vertex_offsets', (len(batch) + 1,), np.int64)
+        face_offsets = self._buffer('face_offsets', (len(batch) + 1,), np.int64)
+        vertex_offsets[0] = 0
+        face_offsets[0] = 0
+        np.cumsum(vert_counts, out=vertex_offsets[1:])
+        np.cumsum(face_counts, out=face_offsets[1:])
+        for i, mesh in enumerate(batch):
+            vertices[vertex_offsets[i]:vertex_offsets[i + 1]] = mesh.vertices
+            np.add(mesh.faces, vertex_offsets[i], out=faces[face_offsets[i]:face_offsets[i + 1]], casting='unsafe')
+        return RaggedMeshBatch(vertices, vertex_offsets, faces, face_offsets)
@@ -1,4 +1,6 @@
 import numpy as np
+import multiprocessing as mp
+from functools import partial
 
 
 class Dataset(object):
@@ -27,3 +29,43 @@ class DatasetDispatcher(Dataset):
 
     def __len__(self):
         return self.length
+
+
+# pool owner of a forked worker, set by _init_fork_worker
+_fork_owner = None
+
+
+def _init_fork_worker(owner, initializer, initargs):
+    global _fork_owner
+    _fork_owner = owner
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _call_owner(name, *args):
+    return getattr(_fork_owner, name)(*args)
+
+
+def fork_pool(owner, num_workers, initializer=None, initargs=()):
+    # process pool whose workers inherit owner through fork instead of pickling it, so large tables and memory
+    # maps are shared copy-on-write. tasks name a method of owner, see owner_method
+    return mp.get_context('fork').Pool(num_workers, initializer=_init_fork_worker,
+                                       initargs=(owner, initializer, initargs))
+
+
+def owner_method(name):
+    # picklable stand-in for a bound method of the pool owner
+    return partial(_call_owner, name)
+
+
+def close_pool(pool, wait=False):
+    # by default the workers are stopped right away, they may still run tasks nobody waits for anymore.
+    # wait=True lets the submitted tasks finish instead, for owners that keep only a few in flight: terminate()
+    # hangs on a worker that is still sending a large result, its sentinel needs the result queue lock
+    if pool is None:
+        return
+    if wait:
+        pool.close()
+    else:
+        pool.terminate()
+    pool.join()
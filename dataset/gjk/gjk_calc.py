@@ -1,23 +1,90 @@
 import ctypes
 import numpy as np
 import os
+from collections import namedtuple
 
 BASE_PATH = os.path.dirname(__file__)
 lib = ctypes.cdll.LoadLibrary(os.path.join(BASE_PATH, 'gjk_wrapper.so'))
+
+_verts_ptr = np.ctypeslib.ndpointer(dtype=np.float64, flags='C_CONTIGUOUS')
+_index_ptr = np.ctypeslib.ndpointer(dtype=np.int64, flags='C_CONTIGUOUS')
+_hit_ptr = np.ctypeslib.ndpointer(dtype=np.intc, flags='C_CONTIGUOUS')
+
 dist_squared_func = lib.polyhedron_intersect_polyhedron
 dist_squared_func.restype = ctypes.c_double
+dist_squared_func.argtypes = [_verts_ptr, ctypes.c_int, _verts_ptr, ctypes.c_int]
+
+pairs_func = lib.polyhedra_distance_pairs
+pairs_func.restype = None
+pairs_func.argtypes = [_verts_ptr, _index_ptr, _index_ptr, ctypes.c_longlong,
+                       _verts_ptr, _verts_ptr, _verts_ptr, _hit_ptr]
+
+matrix_func = lib.polyhedra_distance_matrix
+matrix_func.restype = None
+matrix_func.argtypes = [_verts_ptr, _index_ptr, ctypes.c_longlong,
+                        _verts_ptr, _verts_ptr, _verts_ptr, _hit_ptr]
+
+# distance between the polyhedra, closest point on the first and on the second one, whether they intersect
+GJKResult = namedtuple('GJKResult', ['distance', 'witness_a', 'witness_b', 'hit'])
+
+
+def _as_verts(verts):
+    # the C side walks raw memory, so hand it contiguous float64 (N, 3) only
+    verts = np.ascontiguousarray(verts, dtype=np.float64)
+    if verts.ndim != 2 or verts.shape[1] != 3 or len(verts) == 0:
+        raise ValueError("expected a non-empty (N, 3) vertex array, got shape {}".format(verts.shape))
+    return verts
+
+
+def _as_polyhedra(polyhedra, offsets=None):
+    # (N, K, 3) equal-sized polyhedra such as (N, 8, 3) boxes, or (V, 3) vertices split by (N + 1,) offsets
+    polyhedra = np.asarray(polyhedra)
+    if offsets is None:
+        if polyhedra.ndim != 3 or polyhedra.shape[1] == 0:
+            raise ValueError("expected (N, K, 3) polyhedra or vertices with offsets, got shape {}".format(polyhedra.shape))
+        offsets = np.arange(len(polyhedra) + 1, dtype=np.int64) * polyhedra.shape[1]
+        verts = np.ascontiguousarray(polyhedra.reshape(-1, 3), dtype=np.float64)
+        return verts, offsets
+    verts = _as_verts(polyhedra)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    if offsets[0] != 0 or offsets[-1] != len(verts) or np.any(np.diff(offsets) <= 0):
+        raise ValueError("offsets must start at 0, end at the vertex count and leave no polyhedron empty")
+    return verts, offsets
 
 
 def calc(bbox_a, bbox_b):
-    res = dist_squared_func(
-        ctypes.c_void_p(bbox_a.ctypes.data),
-        ctypes.c_int(len(bbox_a)),
-        ctypes.c_void_p(bbox_b.ctypes.data),
-        ctypes.c_int(len(bbox_b))
-    )
+    bbox_a = _as_verts(bbox_a)
+    bbox_b = _as_verts(bbox_b)
+    res = dist_squared_func(bbox_a, len(bbox_a), bbox_b, len(bbox_b))
     return np.sqrt(res)
 
 
+def calc_pairs(polyhedra, pairs, offsets=None):
+    # GJKResult of every (i, j) row of pairs, (M,) distances and hits, (M, 3) witnesses
+    verts, offsets = _as_polyhedra(polyhedra, offsets)
+    pairs = np.ascontiguousarray(pairs, dtype=np.int64).reshape(-1, 2)
+    if len(pairs) > 0 and (pairs.min() < 0 or pairs.max() >= len(offsets) - 1):
+        raise IndexError("pair index out of range for {} polyhedra".format(len(offsets) - 1))
+    dist_squared = np.empty(len(pairs), dtype=np.float64)
+    witness_a = np.empty((len(pairs), 3), dtype=np.float64)
+    witness_b = np.empty((len(pairs), 3), dtype=np.float64)
+    hit = np.empty(len(pairs), dtype=np.intc)
+    pairs_func(verts, offsets, pairs, len(pairs), dist_squared, witness_a, witness_b, hit)
+    return GJKResult(np.sqrt(dist_squared), witness_a, witness_b, hit.astype(bool))
+
+
+def calc_matrix(polyhedra, offsets=None):
+    # GJKResult of all pairs, (N, N) distances and hits, (N, N, 3) witnesses; witness_a[i, j] lies on polyhedron i
+    verts, offsets = _as_polyhedra(polyhedra, offsets)
+    n = len(offsets) - 1
+    dist_squared = np.empty((n, n), dtype=np.float64)
+    witness_a = np.empty((n, n, 3), dtype=np.float64)
+    witness_b = np.empty((n, n, 3), dtype=np.float64)
+    hit = np.empty((n, n), dtype=np.intc)
+    matrix_func(verts, offsets, n, dist_squared, witness_a, witness_b, hit)
+    return GJKResult(np.sqrt(dist_squared), witness_a, witness_b, hit.astype(bool))
+
+
 if __name__ == '__main__':
     b1 = np.array([[0, 0, 0],
                    [0, 0, 1],
@@ -36,3 +103,4 @@ if __name__ == '__main__':
                    [2, 2, -1],
                    [2, 2, 2]], dtype=np.double)
     calc(b1, b2)
+    print(calc_matrix(np.stack([b1, b2, b1 + 3])).distance)
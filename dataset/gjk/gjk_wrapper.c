@@ -16,8 +16,8 @@ polyhedron_support(double *support, const double *d,
     return imax;
 }
 
-extern double
-polyhedron_intersect_polyhedron(
+static void
+polyhedron_query(struct gjk_result *res,
     const double *averts, int acnt,
     const double *bverts, int bcnt)
 {
@@ -27,17 +27,12 @@ polyhedron_intersect_polyhedron(
     f3cpy(s.a, averts);
     f3cpy(s.b, bverts);
     f3sub(d, s.b, s.a);
-    //printf("d: %f %f %f\n", d[0], d[1], d[2]);
-    //printf("averts: %f %f %f\n", averts[0], averts[1], averts[2]);
-    //printf("bverts: %f %f %f\n", bverts[0], bverts[1], bverts[2]);
 
     /* run gjk algorithm */
     struct gjk_simplex gsx = {0};
     while (gjk(&gsx, &s, d)) {
         /* transform direction */
         double n[3]; f3mul(n, d, -1);
-        //printf("d: %f %f %f\n", d[0], d[1], d[2]);
-        //printf("n: %f %f %f\n", n[0], n[1], n[2]);
 
         /* run support function on tranformed directions  */
         s.aid = polyhedron_support(s.a, n, averts, acnt);
@@ -47,9 +42,67 @@ polyhedron_intersect_polyhedron(
         f3sub(d, s.b, s.a);
     }
     /* check distance between closest points */
+    gjk_analyze(res, &gsx);
+}
+
+extern double
+polyhedron_intersect_polyhedron(
+    const double *averts, int acnt,
+    const double *bverts, int bcnt)
+{
     struct gjk_result res;
-    //printf("%d\n", gsx.hit);
-    gjk_analyze(&res, &gsx);
-    //printf("%f\n", res.distance_squared);
+    polyhedron_query(&res, averts, acnt, bverts, bcnt);
     return res.distance_squared;
 }
+
+/* polyhedron i is verts[offsets[i]*3 .. offsets[i+1]*3), the query of pair k is
+ * (pairs[2k], pairs[2k+1]). fills the squared distance, the closest points on
+ * both polyhedra (witness_a/witness_b, 3 doubles each) and the hit flag */
+extern void
+polyhedra_distance_pairs(
+    const double *verts, const long long *offsets,
+    const long long *pairs, long long npairs,
+    double *dist_squared, double *witness_a, double *witness_b, int *hit)
+{
+    for (long long k = 0; k < npairs; ++k) {
+        long long i = pairs[2*k], j = pairs[2*k+1];
+        struct gjk_result res;
+        polyhedron_query(&res,
+            &verts[offsets[i]*3], (int)(offsets[i+1] - offsets[i]),
+            &verts[offsets[j]*3], (int)(offsets[j+1] - offsets[j]));
+        dist_squared[k] = res.distance_squared;
+        f3cpy(&witness_a[k*3], res.p0);
+        f3cpy(&witness_b[k*3], res.p1);
+        hit[k] = res.hit;
+    }
+}
+
+/* all pairs of n polyhedra into row-major n x n outputs, witness_a[i, j] lies on
+ * polyhedron i and witness_b[i, j] on polyhedron j; the diagonal is a hit at
+ * distance 0 with the first vertex as witness */
+extern void
+polyhedra_distance_matrix(
+    const double *verts, const long long *offsets, long long n,
+    double *dist_squared, double *witness_a, double *witness_b, int *hit)
+{
+    for (long long i = 0; i < n; ++i) {
+        long long ii = i*n + i;
+        dist_squared[ii] = 0;
+        f3cpy(&witness_a[ii*3], &verts[offsets[i]*3]);
+        f3cpy(&witness_b[ii*3], &verts[offsets[i]*3]);
+        hit[ii] = 1;
+        for (long long j = i + 1; j < n; ++j) {
+            long long ij = i*n + j, ji = j*n + i;
+            struct gjk_result res;
+            polyhedron_query(&res,
+                &verts[offsets[i]*3], (int)(offsets[i+1] - offsets[i]),
+                &verts[offsets[j]*3], (int)(offsets[j+1] - offsets[j]));
+            dist_squared[ij] = dist_squared[ji] = res.distance_squared;
+            f3cpy(&witness_a[ij*3], res.p0);
+            f3cpy(&witness_b[ij*3], res.p1);
+            f3cpy(&witness_a[ji*3], res.p1);
+            f3cpy(&witness_b[ji*3], res.p0);
+            hit[ij] = hit[ji] = res.hit;
+        }
+    }
+}
@@ -2,8 +2,16 @@ import pymesh
 import trimesh
 import numpy as np
 from itertools import product
+from collections import namedtuple
 import open3d as o3d
 
+# light-weight mesh returned by the binary stores, exposes the same fields as a pymesh mesh
+MeshView = namedtuple('MeshView', ['vertices', 'faces'])
+
+# corner i of a box sits at BOX_CORNER_SIGNS[i] * half extents in the box frame, ordered like product([-1, 1], ...)
+# so corners 1, 2 and 4 are the neighbours of corner 0 along the local z, y and x axes
+BOX_CORNER_SIGNS = np.array(list(product([-1, 1], repeat=3)), dtype=np.float64)
+
 
 def load_pc(path):
     # with stdout_redirected():
@@ -22,24 +30,168 @@ def get_pc(pc):
     return pc.vertices
 
 
+def load_merged_mesh(obj_paths):
+    mesh_list = []
+    for obj_path in obj_paths:
+        mesh_tmp = load_pc(obj_path)
+        mesh_tmp, info = pymesh.remove_isolated_vertices(mesh_tmp)
+        mesh_list.append(mesh_tmp)
+    return pymesh.merge_meshes(mesh_list)
+
+
 def pymesh_to_trimesh(mesh_pymesh):
     return trimesh.Trimesh(vertices=mesh_pymesh.vertices, faces=mesh_pymesh.faces)
 
 
-def get_bbox(mesh):
-    mesh_tri = pymesh_to_trimesh(mesh)
-    obb = mesh_tri.bounding_box_oriented
+def get_bbox(mesh, engine='trimesh'):
+    # (corners, full extents, box-to-world transform) of the oriented box, engine is a key of OBB_ENGINES
+    return OBB_ENGINES[engine](mesh.vertices, mesh.faces)
+
+
+def obb_trimesh(vertices, faces=None):
+    # reference engine, trimesh's minimum volume search
+    obb = trimesh.Trimesh(vertices=vertices, faces=faces).bounding_box_oriented
     extents_raw = np.array(obb.primitive.extents)
-    extents = np.array(obb.primitive.extents) / 2
     transform = np.array(obb.primitive.transform)
-    template = [-1, 1]
-    res = []
-    for mask in product(template, template, template):
-        relative = mask * extents
-        relative_homo = np.array([*(relative.tolist()), 1])
-        world_homo = np.dot(transform, relative_homo)
-        res.append(world_homo[:-1])
-    return np.row_stack(res), extents_raw, transform
+    return get_bbox_corners(transform, extents_raw), extents_raw, transform
+
+
+def _obb_from_rotation(vertices, rotation):
+    # tightest box whose axes are the columns of rotation
+    projected = np.dot(vertices, rotation)
+    p_min = projected.min(axis=0)
+    p_max = projected.max(axis=0)
+    extents = p_max - p_min
+    transform = np.eye(4)
+    transform[:3, :3] = rotation
+    transform[:3, 3] = np.dot(rotation, (p_max + p_min) / 2)
+    return get_bbox_corners(transform, extents), extents, transform
+
+
+def obb_pca(vertices, faces=None):
+    # axes of the vertex covariance, fastest but not minimal for uneven vertex densities
+    vertices = np.asarray(vertices, dtype=np.float64)
+    _, eigv = np.linalg.eigh(np.cov(vertices, rowvar=False, bias=True))
+    if np.linalg.det(eigv) < 0:
+        eigv[:, 0] = -eigv[:, 0]
+    return _obb_from_rotation(vertices, eigv)
+
+
+def _unique_directions(directions):
+    # unit directions without duplicates, d and -d count as one
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    first = np.argmax(np.abs(directions) > 1e-9, axis=1)
+    directions = directions * np.sign(directions[np.arange(len(directions)), first])[:, None]
+    _, keep = np.unique(np.round(directions, 6), axis=0, return_index=True)
+    return directions[np.sort(keep)]
+
+
+def _min_area_rect(hull):
+    # rotating calipers over a counterclockwise convex polygon: (area, unit edge direction) of the smallest
+    # rectangle, which always has a side on a polygon edge. the supporting vertices of every edge come from
+    # merging the sorted edge angles (searchsorted) instead of advancing four pointers
+    edges = hull[np.r_[1:len(hull), 0]] - hull
+    angles = np.arctan2(edges[:, 1], edges[:, 0])
+    # hull vertices are counterclockwise, so the edge angles increase once started at the smallest one
+    order = np.r_[np.argmin(angles):len(hull), 0:np.argmin(angles)]
+    hull, edges, angles = hull[order], edges[order], angles[order] - angles[order[0]]
+    direction = edges / np.sqrt((edges ** 2).sum(axis=1))[:, None]
+
+    def support(offset):
+        # vertex furthest along the direction offset radians from each edge: the one between the last edge
+        # turned less than that direction + pi / 2 and the next one
+        return hull[np.searchsorted(angles, np.mod(angles + (offset + np.pi / 2), 2 * np.pi)) % len(hull)]
+
+    span = support(0.0) - support(np.pi)
+    width = span[:, 0] * direction[:, 0] + span[:, 1] * direction[:, 1]
+    # the inward normal of an edge is its direction turned by pi / 2
+    rise = support(np.pi / 2) - hull
+    height = rise[:, 1] * direction[:, 0] - rise[:, 0] * direction[:, 1]
+    best = np.argmin(width * height)
+    return width[best] * height[best], direction[best]
+
+
+def obb_calipers(vertices, faces=None, block_size=256):
+    # for every convex hull face normal, the hull is projected onto the face plane and the smallest rectangle
+    # of the projection is found with rotating calipers. the outline of the projection is the silhouette (the
+    # hull edges between a face turned towards the normal and one that is not), so just those vertices are
+    # projected and no 2d hull is needed.
+    # the rectangle is never smaller than the shadow of the hull (half the summed |face area . normal|), so
+    # height * shadow bounds the box volume from below and the normals are visited in order of that bound until
+    # it exceeds the best box. the minimal box need not rest on a hull face, the search starts from the pca box
+    # and keeps it when no face normal does better. block_size bounds the (hull points, normals) blocks of the bound computation
+    from scipy.spatial import ConvexHull
+    vertices = np.asarray(vertices, dtype=np.float64)
+    try:
+        hull = ConvexHull(vertices)
+    except Exception:
+        # flat or degenerate parts, joggling keeps the hull well defined
+        hull = ConvexHull(vertices, qhull_options='QJ')
+    points = vertices[hull.vertices]
+    normals = _unique_directions(hull.equations[:, :3])
+    corners = vertices[hull.simplices]
+    face_areas = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]) / 2
+    # every hull edge once, with the faces on both sides: the edge of face f opposite its k-th vertex
+    face, k = np.nonzero(hull.neighbors > np.arange(len(hull.simplices))[:, None])
+    edge_faces = np.stack([face, hull.neighbors[face, k]], axis=1)
+    edge_verts = np.stack([hull.simplices[face, (k + 1) % 3], hull.simplices[face, (k + 2) % 3]], axis=1)
+
+    heights = np.empty(len(normals))
+    shadows = np.empty(len(normals))
+    for start in range(0, len(normals), block_size):
+        block = normals[start:start + block_size]
+        heights[start:start + block_size] = np.ptp(np.dot(points, block.T), axis=0)
+        shadows[start:start + block_size] = np.abs(np.dot(face_areas, block.T)).sum(axis=0) / 2
+    bounds = heights * shadows
+    scale = np.ptp(points, axis=0).max()
+    # orthonormal bases (u, v) of the face planes
+    u = np.cross(normals, np.where(np.abs(normals[:, :1]) < 0.9, [[1.0, 0.0, 0.0]], [[0.0, 1.0, 0.0]]))
+    u /= np.linalg.norm(u, axis=1, keepdims=True)
+    v = np.cross(normals, u)
+
+    # the pca box is the box to beat, the search stops as soon as no face normal can
+    res_pca = obb_pca(vertices)
+    best_volume, best_rotation = np.prod(res_pca[1]), None
+    visit = np.argsort(bounds)
+    for j, i in enumerate(visit):
+        if bounds[i] >= best_volume:
+            break
+        if j % 32 == 0:
+            # silhouettes of the next 32 normals at once
+            front = np.dot(hull.equations[:, :3], normals[visit[j:j + 32]].T) > 0
+            silhouettes = (front[edge_faces[:, 0]] != front[edge_faces[:, 1]]).T
+        normal = normals[i]
+        outline = np.dot(vertices[np.unique(edge_verts[silhouettes[j % 32]])], np.array([u[i], v[i]]).T)
+        # the outline points are in convex position, sorting them by angle around their mean orders the polygon
+        offset = outline - outline.mean(axis=0)
+        outline = outline[np.argsort(np.arctan2(offset[:, 1], offset[:, 0]))]
+        outline = outline[np.abs(np.r_[outline[1:], outline[:1]] - outline).sum(axis=1) > 1e-12 * scale]
+        if len(outline) < 3:
+            # the projection is degenerate (collinear), the pca box covers such parts
+            continue
+        area, direction = _min_area_rect(outline)
+        if heights[i] * area < best_volume:
+            best_volume = heights[i] * area
+            second = direction[0] * u[i] + direction[1] * v[i]
+            best_rotation = np.array([normal, second, np.cross(normal, second)]).T
+    if best_rotation is None:
+        return res_pca
+    return _obb_from_rotation(vertices, best_rotation)
+
+
+OBB_ENGINES = {
+    'pca': obb_pca,
+    'calipers': obb_calipers,
+    'trimesh': obb_trimesh,
+}
+
+
+def get_bbox_corners(transforms, extents):
+    # (N, 4, 4) box-to-world transforms and (N, 3) full extents -> (N, 8, 3) corners, unbatched inputs give (8, 3)
+    transforms = np.asarray(transforms, dtype=np.float64)
+    extents = np.asarray(extents, dtype=np.float64)
+    relative = BOX_CORNER_SIGNS * (extents[..., None, :] / 2)
+    return np.matmul(relative, np.swapaxes(transforms[..., :3, :3], -1, -2)) + transforms[..., None, :3, 3]
 
 
 def get_brect(plane_mesh):
@@ -57,17 +209,7 @@ def get_brect(plane_mesh):
     pc_projected_min = np.min(pc_projected, axis=0)
     pc_projected_max = np.max(pc_projected, axis=0)
 
-    pc_projected_rect_list = [
-        pc_projected_min,
-        np.array((pc_projected_min[0], pc_projected_min[1], pc_projected_max[2])),
-        np.array((pc_projected_min[0], pc_projected_max[1], pc_projected_min[2])),
-        np.array((pc_projected_min[0], pc_projected_max[1], pc_projected_max[2])),
-        np.array((pc_projected_max[0], pc_projected_min[1], pc_projected_min[2])),
-        np.array((pc_projected_max[0], pc_projected_min[1], pc_projected_max[2])),
-        np.array((pc_projected_max[0], pc_projected_max[1], pc_projected_min[2])),
-        pc_projected_max
-    ]
-    pc_projected_rect = np.stack(pc_projected_rect_list)
+    pc_projected_rect = np.where(BOX_CORNER_SIGNS > 0, pc_projected_max, pc_projected_min)
     bbox = np.dot(rotation.T, pc_projected_rect.T).T
 
     extent = pc_projected_max - pc_projected_min
@@ -80,22 +222,60 @@ def get_brect(plane_mesh):
     return bbox, transform, extent
 
 
+def get_bbox_extents(bboxes):
+    # (N, 8, 3) corners -> (N, 3) edge lengths along the local z, y and x axes
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    return np.linalg.norm(bboxes[..., [1, 2, 4], :] - bboxes[..., :1, :], axis=-1)
+
+
+def get_bbox_volumes(bboxes):
+    # (N, 8, 3) corners -> (N,) volumes
+    return np.prod(get_bbox_extents(bboxes), axis=-1)
+
+
+def get_bbox_aabbs(bboxes):
+    # (N, 8, 3) corners -> (N, 3) lower and (N, 3) upper corners of the axis-aligned bounds
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    return bboxes.min(axis=-2), bboxes.max(axis=-2)
+
+
+def get_aabb_distances(lo, hi):
+    # (N, N) distances between axis-aligned bounds, a lower bound of the distance of anything inside them
+    gap = np.maximum(0, np.maximum(lo[None, :, :] - hi[:, None, :], lo[:, None, :] - hi[None, :, :]))
+    return np.linalg.norm(gap, axis=-1)
+
+
+def get_aabb_distances_to(lo, hi, query_lo, query_hi):
+    # (N,) distances between N axis-aligned bounds and one query bound
+    gap = np.maximum(0, np.maximum(lo - query_hi, query_lo - hi))
+    return np.linalg.norm(gap, axis=-1)
+
+
+def sweep_and_prune(lo, hi, threshold=0.0):
+    # (M, 2) pairs i < j of axis-aligned bounds at most threshold apart. bounds are swept along the axis of
+    # largest spread, so only pairs overlapping there (grown by threshold) are ever looked at
+    n = len(lo)
+    if n < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+    axis = np.argmax(np.nanmax(hi, axis=0) - np.nanmin(lo, axis=0))
+    order = np.argsort(lo[:, axis], kind='stable')
+    starts = np.arange(1, n + 1)
+    ends = np.searchsorted(lo[order, axis], hi[order, axis] + threshold, side='right')
+    counts = np.maximum(ends - starts, 0)
+    first = np.repeat(np.arange(n), counts)
+    second = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    a, b = order[first], order[second]
+    gap = np.maximum(0, np.maximum(lo[b] - hi[a], lo[a] - hi[b]))
+    keep = np.linalg.norm(gap, axis=1) <= threshold
+    return np.sort(np.stack([a[keep], b[keep]], axis=1), axis=1)
+
+
 def get_bbox_extent(bbox):
-    # hard-coded
-    pairs = [(0, 1), (0, 2), (0, 4)]
-    res = []
-    for a, b in pairs:
-        res.append(np.linalg.norm(bbox[a, :] - bbox[b, :]))
-    return np.array(res)
+    return get_bbox_extents(bbox)
 
 
 def get_bbox_volume(bbox):
-    # hard-coded
-    pairs = [(0, 1), (0, 2), (0, 4)]
-    res = []
-    for a, b in pairs:
-        res.append(np.linalg.norm(bbox[a, :] - bbox[b, :]))
-    return res[0] * res[1] * res[2]
+    return float(get_bbox_volumes(bbox))
 
 
 def get_border_edge(mesh):
@@ -0,0 +1,66 @@
+import os
+import sys
+
+BASE_PATH = os.path.dirname(__file__)
+sys.path.append(BASE_PATH)
+from mesh_util import load_merged_mesh, OBB_ENGINES
+from partnet_config import cfg
+from partnet_meta_constructor import PartnetMetaConstructor
+
+import time
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+def benchmark_obb(meta_constructor, cat=None, num_parts=500, engines=('pca', 'calipers', 'trimesh'),
+                  reference='trimesh', seed=0):
+    # fits every engine to the same random leaves, reports the time per part and the box volume
+    # relative to the reference engine (< 1 means tighter than the reference)
+    meta = meta_constructor.df
+    part_index = meta_constructor.part_index
+    if cat is None:
+        leaf_ids = part_index.leaf_ids
+    else:
+        leaf_ids = part_index.leafs_of_items(np.flatnonzero((meta['cat'] == cat).to_numpy()))
+    rng = np.random.RandomState(seed)
+    leaf_ids = np.sort(rng.choice(leaf_ids, size=min(num_parts, len(leaf_ids)), replace=False))
+    obj_table = meta_constructor.get_obj_table(leaf_ids)
+
+    print(">>> Loading {} Leaf Meshes".format(len(leaf_ids)))
+    meshes = [load_merged_mesh(obj_table.get_paths(i)) for i in tqdm(range(len(leaf_ids)))]
+
+    volumes = {}
+    stats = []
+    for engine in engines:
+        obb = OBB_ENGINES[engine]
+        volume = np.full(len(meshes), np.nan)
+        failures = 0
+        start = time.time()
+        for i, mesh in enumerate(meshes):
+            try:
+                _, extents, _ = obb(mesh.vertices, mesh.faces)
+                volume[i] = np.prod(extents)
+            except Exception:
+                failures += 1
+        elapsed = time.time() - start
+        volumes[engine] = volume
+        stats.append({'engine': engine, 'ms_per_part': 1000 * elapsed / max(len(meshes), 1), 'failures': failures})
+
+    res = pd.DataFrame(stats).set_index('engine')
+    if reference in volumes:
+        for engine in engines:
+            ratio = volumes[engine] / volumes[reference]
+            ratio = ratio[np.isfinite(ratio)]
+            if len(ratio) == 0:
+                continue
+            res.loc[engine, 'volume_mean'] = ratio.mean()
+            res.loc[engine, 'volume_median'] = np.median(ratio)
+            res.loc[engine, 'volume_max'] = ratio.max()
+    return res
+
+
+if __name__ == '__main__':
+    m = PartnetMetaConstructor(cfg.partnet)
+    m.construct_meta()
+    print(benchmark_obb(m))
@@ -3,161 +3,319 @@ import sys
 
 BASE_PATH = os.path.dirname(__file__)
 sys.path.append(BASE_PATH)
-from dataset_util import Dataset
-from mesh_util import load_pc, get_pc, draw_boxes3d, get_bbox_volume, get_bbox_extent
+from dataset_util import Dataset, fork_pool, owner_method, close_pool
+from mesh_util import get_pc, load_merged_mesh, draw_boxes3d, get_bbox_volumes, get_bbox_extent, \
+    get_bbox_aabbs, get_aabb_distances, sweep_and_prune
 from partnet_config import cfg
 from partnet_meta_constructor import PartnetMetaConstructor
 from partnet_bbox_constructor import PartnetBBoxDataset
+from partnet_part_index import gather_ranges
+from partnet_graph_store import PartnetGraph, PartnetGraphStore, GRAPH_STORE_NAME, graph_from_dense, \
+    pack_graph_store, read_packed
 from preprocess import *
 from gjk import gjk_calc
-from multiprocessing import Process
 
 import trimesh
 import pymesh
 import random
+import time
 import numpy as np
 import pandas as pd
-import pickle
+import shutil
 from tqdm import tqdm
 
-from itertools import combinations
-
-
 class PartnetAdjacencyConstructor():
-    def __init__(self, meta_constructor, graph_dir=None):
+    # leaf pairs whose axis-aligned bounds are more than adj_threshold apart skip GJK and keep the bound
+    # distance, a lower bound of the box distance; adjacency (distance 0) is exact for any adj_threshold >= 0.
+    # adj_threshold=None runs GJK on every pair, the full distance matrix of the original build.
+    # the default 0.0 only keeps the touching pairs: pairs further apart are not stored at all, so their exact
+    # distance is not available from the graph. adj_threshold heads the manifest and the store header next to
+    # the meta fingerprint, graphs built with different thresholds are never mixed.
+    # the graph of every item is kept as an edge list of the leaf pairs within adj_threshold (all pairs for None),
+    # items are written as <graph_dir>/items/<item_id>.npz and packed into <graph_dir>/graph_store.bin at the end.
+    # store_bboxes also packs the leaf boxes of every item next to its graph; the graphs are built from the
+    # boxes, so rebuild with use_cache=False after rebuilding the bbox store
+    def __init__(self, meta_constructor, graph_dir=None, adj_threshold=0.0, bbox_dir=None, store_bboxes=False):
         self.meta_constructor = meta_constructor
         self.meta = self.meta_constructor.df
         self.parts = self.meta_constructor.parts
         self.part_parent_child = self.meta_constructor.part_parent_child
         self.part_sibling = self.meta_constructor.part_sibling
         self.part_leaf = self.meta_constructor.part_leaf
+        self.part_index = self.meta_constructor.part_index
+        self.obj_table = self.meta_constructor.get_obj_table(self.parts.index)
 
-        self.bbox_dataset = PartnetBBoxDataset(self.meta_constructor)
+        self.bbox_dataset = PartnetBBoxDataset(self.meta_constructor, bbox_dir=bbox_dir)
 
         if graph_dir is None:
             self.graph_dir = cfg.graph_dir
         else:
             self.graph_dir = graph_dir
+        self.adj_threshold = adj_threshold
+        self.store_bboxes = store_bboxes
 
     def _get_part_of_instance(self, item_id):
-        all_parts = self.parts[self.parts['item_id'] == item_id]['global_id']
-        joined_parts_id = self.part_leaf[self.part_leaf['leaf_global_id'].isin(all_parts)]['leaf_global_id']
-        joined_parts = self.parts[self.parts['global_id'].isin(joined_parts_id)]
-        return joined_parts
+        return self.parts.iloc[self.part_index.leafs_of_items([item_id])]
+
+    def _load_mesh(self, part_id):
+        return load_merged_mesh(self.obj_table.get_paths(part_id))
+
+    def _get_dist_mat(self, leaf_bbox, item_id):
+        # box distances of all leaf pairs with 1.0 on the diagonal, 10.0 marks pairs GJK could not handle;
+        # also returns the number of pairs that went through GJK
+        num_pairs = 0
+        try:
+            if self.adj_threshold is None:
+                adj_mat = gjk_calc.calc_matrix(leaf_bbox).distance
+                num_pairs = len(leaf_bbox) * (len(leaf_bbox) - 1) // 2
+            else:
+                lo, hi = get_bbox_aabbs(leaf_bbox)
+                adj_mat = get_aabb_distances(lo, hi)
+                pairs = sweep_and_prune(lo, hi, self.adj_threshold)
+                dist = gjk_calc.calc_pairs(leaf_bbox, pairs).distance
+                adj_mat[pairs[:, 0], pairs[:, 1]] = dist
+                adj_mat[pairs[:, 1], pairs[:, 0]] = dist
+                num_pairs = len(pairs)
+        except Exception as e:
+            tqdm.write(repr(e))
+            adj_mat = np.full((len(leaf_bbox), len(leaf_bbox)), np.nan)
+        if not np.all(np.isfinite(adj_mat)):
+            tqdm.write('=======')
+            tqdm.write('GJK Error Detected for {}'.format(item_id))
+            tqdm.write('More information:')
+            tqdm.write(str(self.meta.iloc[item_id]))
+            adj_mat[~np.isfinite(adj_mat)] = 10.0
+        np.fill_diagonal(adj_mat, 1.0)
+        return adj_mat, num_pairs
 
     @staticmethod
-    def _load_mesh(desc):
-        path = desc['objs_dir']
-        objs = desc['objs']
-        mesh_list = []
-        for obj in eval(objs):
-            obj_path = os.path.join(path, obj + '.obj')
-            mesh_tmp = load_pc(obj_path)
-            mesh_tmp, info = pymesh.remove_isolated_vertices(mesh_tmp)
-            mesh_list.append(mesh_tmp)
-        mesh = pymesh.merge_meshes(mesh_list)
-        return mesh
-
-    def construct_adj_graph(self, verbose=False, use_cache=True):
-        if use_cache:
-            return None
+    def _get_larger(leaf_volume):
+        # larger[i, j]: edges between i and j run from i to j; on equal volumes the lower index is the larger one
+        upper = np.triu(np.ones((len(leaf_volume), len(leaf_volume)), dtype=bool), 1)
+        larger = np.where(upper, leaf_volume[:, None] >= leaf_volume[None, :], leaf_volume[:, None] > leaf_volume[None, :])
+        np.fill_diagonal(larger, False)
+        return larger
+
+    def _dump_item(self, item_id, graph):
+        # written under a temporary name, a crash never leaves a truncated item behind
+        shard_path = os.path.join(self.graph_dir, 'items', str(item_id))
+        np.savez(shard_path + '.tmp.npz', **graph._asdict())
+        os.replace(shard_path + '.tmp.npz', shard_path + '.npz')
 
+    def _load_item(self, item_id, packed=None):
+        # items packed before come from the packed store
+        shard_path = os.path.join(self.graph_dir, 'items', str(item_id) + '.npz')
+        if packed is not None and not os.path.exists(shard_path):
+            return packed[item_id]
+        with np.load(shard_path) as shard:
+            return PartnetGraph(*(shard[name] for name in PartnetGraph._fields))
+
+    def _store_is_current(self):
+        store_path = os.path.join(self.graph_dir, GRAPH_STORE_NAME)
+        if not os.path.exists(store_path):
+            return False
+        info, _ = read_packed(store_path)
+        return info['fingerprint'] == self.meta_constructor.fingerprint and info.get('bboxes', False) == self.store_bboxes \
+            and info.get('adj_threshold', 0.0) == self.adj_threshold
+
+    def _manifest_header(self):
+        return "{}\tadj_threshold={}".format(self.meta_constructor.fingerprint, self.adj_threshold)
+
+    def _construct_item(self, item_id, verbose=False):
+        # (item_id, seconds, number of leaves, number of GJK pairs)
+        start = time.time()
         if verbose:
+            print("============")
+        leaf_desc = self._get_part_of_instance(item_id)
+        leaf_id = list(leaf_desc['global_id'])
+        leaf_bbox = self.bbox_dataset[leaf_id]
+        leaf_volume = get_bbox_volumes(leaf_bbox)
+
+        if verbose:
+            print({leaf_id[i]: i for i in range(0, len(leaf_id))})
+        adj_mat, num_pairs = self._get_dist_mat(leaf_bbox, item_id)
+        graph = graph_from_dense(leaf_desc.index, adj_mat, self._get_larger(leaf_volume), self.adj_threshold)
+        if verbose:
+            # meshes are only needed to look at the result
             from mayavi import mlab
+            print(adj_mat)
+            for part_id in leaf_desc.index:
+                mesh = self._load_mesh(part_id)
+                mlab.triangular_mesh(mesh.vertices[:, 0], mesh.vertices[:, 1], mesh.vertices[:, 2], mesh.faces)
+            draw_boxes3d(np.stack(leaf_bbox))
+            mlab.show()
+        self._dump_item(item_id, graph)
+        return item_id, time.time() - start, len(leaf_id), num_pairs
+
+    def load_stats(self):
+        # per-item timing of the finished items of the manifest, None without a manifest of the current meta and adj_threshold
+        manifest_path = os.path.join(self.graph_dir, 'manifest.txt')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            lines = f.read().splitlines()
+        if len(lines) == 0 or lines[0] != self._manifest_header():
+            return None
+        rows = [line.split('\t') for line in lines[1:] if line]
+        stats = pd.DataFrame(rows, columns=['item_id', 'seconds', 'num_leaves', 'num_pairs'])
+        return stats.astype({'item_id': np.int64, 'seconds': np.float64, 'num_leaves': np.int64, 'num_pairs': np.int64})
+
+    def construct_adj_graph(self, verbose=False, use_cache=True, num_workers=0):
+        # use_cache resumes from <graph_dir>/manifest.txt, which records every finished item with its timing;
+        # verbose shows every item and runs serially. returns the timing stats of all finished items
+        if not os.path.isdir(self.meta_constructor.path):
+            raise FileNotFoundError("dataset root {} is missing, the objs are read from it".format(
+                self.meta_constructor.path))
+        manifest_path = os.path.join(self.graph_dir, 'manifest.txt')
+        stats = self.load_stats() if use_cache else None
+        if stats is None:
+            # fresh build: the old store, shards and manifest all go before the new manifest is written
+            if os.path.exists(os.path.join(self.graph_dir, GRAPH_STORE_NAME)):
+                os.remove(os.path.join(self.graph_dir, GRAPH_STORE_NAME))
+            shutil.rmtree(os.path.join(self.graph_dir, 'items'), ignore_errors=True)
+            os.makedirs(os.path.join(self.graph_dir, 'items'))
+            with open(manifest_path, 'w') as f:
+                f.write(self._manifest_header() + '\n')
+            finished = np.zeros(0, dtype=np.int64)
+        else:
+            os.makedirs(os.path.join(self.graph_dir, 'items'), exist_ok=True)
+            finished = stats['item_id'].to_numpy()
 
-        index_list = list(self.meta.index)
-        progress = tqdm(index_list)
-        for item_id in progress:
-            if verbose:
-                print("============")
-            leaf_desc = self._get_part_of_instance(item_id)
-            leaf_id = list(leaf_desc['global_id'])
-            leaf_bbox = [self.bbox_dataset[id] for id in leaf_id]
-            mesh_list = []
-            for i in range(len(leaf_desc)):
-                mesh_list.append(self._load_mesh(leaf_desc.iloc[i]))
-            leaf_id_map = {leaf_id[i]: i for i in range(0, len(leaf_id))}
-
-            adj_mat = np.eye(len(leaf_id))
-            adj_dir_mat = np.eye(len(leaf_id))
-            if verbose:
-                print(leaf_id_map)
-            for id_a, id_b in combinations(leaf_id, 2):
-                bbox_a = leaf_bbox[leaf_id_map[id_a]]
-                bbox_b = leaf_bbox[leaf_id_map[id_b]]
-                try:
-                    bbox_dist = gjk_calc.calc(bbox_a, bbox_b)
-                except Exception as e:
-                    progress.write(e)
-                    progress.write('=======')
-                    progress.write('GJK Error Detected for {}'.format(item_id))
-                    progress.write('More information:')
-                    progress.write(self.meta.iloc[item_id])
-                    bbox_dist = 10.0
-                adj_mat[leaf_id_map[id_a], leaf_id_map[id_b]] = bbox_dist
-                adj_mat[leaf_id_map[id_b], leaf_id_map[id_a]] = bbox_dist
-                if get_bbox_volume(bbox_a) >= get_bbox_volume(bbox_b):
-                    adj_dir_mat[leaf_id_map[id_a], leaf_id_map[id_b]] = bbox_dist
-                    adj_dir_mat[leaf_id_map[id_b], leaf_id_map[id_a]] = 1.0
-                else:
-                    adj_dir_mat[leaf_id_map[id_a], leaf_id_map[id_b]] = 1.0
-                    adj_dir_mat[leaf_id_map[id_b], leaf_id_map[id_a]] = bbox_dist
-            if verbose:
-                print(adj_mat)
-                for mesh in mesh_list:
-                    mlab.triangular_mesh(mesh.vertices[:, 0], mesh.vertices[:, 1], mesh.vertices[:, 2], mesh.faces)
-                draw_boxes3d(np.stack(leaf_bbox))
-                mlab.show()
-            adj_res = adj_mat.copy()
-            adj_res = np.logical_not(adj_res).astype(np.int)
-            adj_dir_res = adj_dir_mat.copy()
-            adj_dir_res = np.logical_not(adj_dir_res).astype(np.int)
-
-            # dump things
-            with open(os.path.join(self.graph_dir, str(item_id) + '_mapping.pkl'), "wb") as stream:
-                pickle.dump(leaf_id_map, stream)
-            np.savetxt(os.path.join(self.graph_dir, str(item_id) + '_dist.txt'), adj_mat)
-            np.savetxt(os.path.join(self.graph_dir, str(item_id) + '.txt'), adj_res)
-            np.savetxt(os.path.join(self.graph_dir, str(item_id) + '_dist_directional.txt'), adj_dir_mat)
-            np.savetxt(os.path.join(self.graph_dir, str(item_id) + '_directional.txt'), adj_dir_res)
+        todo = np.setdiff1d(self.meta.index.to_numpy(), finished)
+        if len(todo) > 0:
+            print(">>> Constructing Adjacency Graphs: {} of {} items left".format(len(todo), len(self.meta)))
+            if num_workers > 0 and not verbose:
+                pool = fork_pool(self, num_workers)
+                results = pool.imap_unordered(owner_method('_construct_item'), todo, chunksize=4)
+            else:
+                pool = None
+                results = (self._construct_item(item_id, verbose=verbose) for item_id in todo)
+
+            start = time.time()
+            try:
+                with open(manifest_path, 'a') as manifest:
+                    for item_id, seconds, num_leaves, num_pairs in tqdm(results, total=len(todo), unit='item'):
+                        manifest.write("{}\t{:.6f}\t{}\t{}\n".format(item_id, seconds, num_leaves, num_pairs))
+                        manifest.flush()
+                        os.fsync(manifest.fileno())
+            finally:
+                close_pool(pool)
+            elapsed = time.time() - start
+            print("=== Completed Constructing Adjacency Graphs: {} items in {:.1f}s ({:.1f} items/s)".format(
+                len(todo), elapsed, len(todo) / max(elapsed, 1e-6)))
+
+        stats = self.load_stats()
+        if len(todo) > 0 or not self._store_is_current():
+            print(">>> Packing Graph Store")
+            store_path = os.path.join(self.graph_dir, GRAPH_STORE_NAME)
+            packed = PartnetGraphStore(self.graph_dir) if os.path.exists(store_path) else None
+            pack_graph_store(store_path, len(self.meta),
+                             ((item_id, self._load_item(item_id, packed)) for item_id in stats['item_id']),
+                             self.meta_constructor.fingerprint,
+                             bboxes=self.bbox_dataset.bboxes if self.store_bboxes else None,
+                             info={'bboxes': self.store_bboxes, 'adj_threshold': self.adj_threshold})
+            del packed
+            shutil.rmtree(os.path.join(self.graph_dir, 'items'))
+            print("=== Completed Packing Graph Store")
+        print(">>> Slowest Items:")
+        print(stats.sort_values('seconds', ascending=False).head(10).to_string(index=False))
+        return stats
 
 
 class PartnetAdjacencyDataset(Dataset):
-    def __init__(self, meta_constructor, graph_dir=None):
+    def __init__(self, meta_constructor, graph_dir=None, bbox_dir=None):
         self.meta_constructor = meta_constructor
         self.meta = self.meta_constructor.df
-        self.bbox_dataset = PartnetBBoxDataset(self.meta_constructor)
+        self.parts = self.meta_constructor.parts
+        self.bbox_dataset = PartnetBBoxDataset(self.meta_constructor, bbox_dir=bbox_dir)
 
         if graph_dir is None:
             self.graph_dir = cfg.graph_dir
         else:
             self.graph_dir = graph_dir
+        self.graph_store = PartnetGraphStore(self.graph_dir, fingerprint=self.meta_constructor.fingerprint)
 
     @staticmethod
-    def toposort(adjmat):
+    def _to_csr(adjmat):
+        # (indptr, indices) of a dense matrix, a csr pair is passed through
+        if isinstance(adjmat, tuple):
+            return np.asarray(adjmat[0]), np.asarray(adjmat[1])
+        adjmat = np.atleast_2d(adjmat)
+        rows, cols = np.nonzero(adjmat)
+        indptr = np.zeros(adjmat.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=adjmat.shape[0]), out=indptr[1:])
+        return indptr, cols
+
+    @staticmethod
+    def toposort(adjmat, num_orders=None, rng=None):
+        # random topological order (Kahn's algorithm, uniform choice among the nodes without incoming edges)
+        # of a dense 0/1 matrix or an (indptr, indices) csr pair. num_orders=K returns a (K, n) array of
+        # independent orders computed together. rng defaults to np.random, a cycle raises ValueError
+        if rng is None:
+            rng = np.random
+        indptr, indices = PartnetAdjacencyDataset._to_csr(adjmat)
+        num_nodes = len(indptr) - 1
+        indegree = np.bincount(indices, minlength=num_nodes)
+
+        if num_orders is not None:
+            # every order keeps its ready nodes in ready[k, :num_ready[k]]; a step picks a uniform position in each,
+            # fills the hole with the last ready node and decrements the successors of the picked nodes
+            rows = np.arange(num_orders)
+            ready = np.zeros((num_orders, num_nodes), dtype=np.int64)
+            first = np.flatnonzero(indegree == 0)
+            ready[:, :len(first)] = first
+            num_ready = np.full(num_orders, len(first), dtype=np.int64)
+            indegree = np.tile(indegree, (num_orders, 1))
+            orders = np.zeros((num_orders, num_nodes), dtype=np.int64)
+            for step in range(num_nodes):
+                if np.any(num_ready == 0):
+                    raise ValueError("graph has a cycle, no topological order exists")
+                pos = np.minimum((rng.random(num_orders) * num_ready).astype(np.int64), num_ready - 1)
+                picked = ready[rows, pos]
+                ready[rows, pos] = ready[rows, num_ready - 1]
+                num_ready -= 1
+                orders[:, step] = picked
+
+                degree = indptr[picked + 1] - indptr[picked]
+                succ_rows = np.repeat(rows, degree)
+                succ = gather_ranges(indptr, picked, indices)
+                # duplicate edges decrement twice, just like they were counted twice in indegree
+                np.add.at(indegree, (succ_rows, succ), -1)
+                freed = np.unique((succ_rows * num_nodes + succ)[indegree[succ_rows, succ] == 0])
+                freed_rows, freed_nodes = freed // num_nodes, freed % num_nodes
+                counts = np.bincount(freed_rows, minlength=num_orders)
+                rank = np.arange(len(freed)) - np.repeat(np.cumsum(counts) - counts, counts)
+                ready[freed_rows, num_ready[freed_rows] + rank] = freed_nodes
+                num_ready += counts
+            return orders
+
+        ready = list(np.flatnonzero(indegree == 0))
         closed = []
-        adjmat = adjmat.copy()
-        try:
-            vertmap = np.arange(adjmat.shape[0])
-        except Exception as exc:
-            return [0]
-
-        while vertmap.size > 0:
-            indegree = np.sum(adjmat, axis=0)
-            picked = np.random.choice(np.where(indegree == 0)[0])
-            closed.append(vertmap[picked])
-            vertmap = np.delete(vertmap, picked, axis=0)
-            adjmat = np.delete(np.delete(adjmat, picked, axis=0), picked, axis=1)
+        while ready:
+            pos = min(int(rng.random() * len(ready)), len(ready) - 1)
+            ready[pos], ready[-1] = ready[-1], ready[pos]
+            node = ready.pop()
+            closed.append(node)
+            for succ in indices[indptr[node]:indptr[node + 1]]:
+                indegree[succ] -= 1
+                if indegree[succ] == 0:
+                    ready.append(succ)
+        if len(closed) != num_nodes:
+            raise ValueError("graph has a cycle, no topological order exists")
         return closed
 
     def __getitem__(self, index):
-        adjmat = np.loadtxt(os.path.join(self.graph_dir, '{}_directional.txt'.format(index)))
-        with open(os.path.join(self.graph_dir, '{}_mapping.pkl'.format(index)), "rb") as stream:
-            idmap = pickle.load(stream)
-        rev_idmap = {v: k for k, v in idmap.items()}
+        # (num_leaves, 8, 3) leaf boxes in a random topological order, gathered with one fancy index from the
+        # boxes packed with the graph (store_bboxes) or else from the bbox store
+        adjmat = self.graph_store.get_adjacency_csr(index, directional=True)
         sortee = self.toposort(adjmat)
-        res = [self.bbox_dataset[rev_idmap[idx]] for idx in sortee]
-        return res
+        if self.graph_store.leaf_corners is not None:
+            return self.graph_store.get_bboxes(index)[sortee]
+        return self.bbox_dataset.bboxes[self.graph_store[index].leaf_ids[sortee]]
+
+    def get_orders(self, index, num_orders):
+        # (num_orders, num_leaves) random topological orders of an item
+        return self.toposort(self.graph_store.get_adjacency_csr(index, directional=True), num_orders=num_orders)
 
     def __len__(self):
         return len(self.meta)
@@ -166,8 +324,8 @@ class PartnetAdjacencyDataset(Dataset):
 if __name__ == '__main__':
     m = PartnetMetaConstructor(cfg.partnet)
     m.construct_meta()
-    # a = PartnetAdjacencyConstructor(m)
-    # a.construct_adj_graph(use_cache=False)
+    # a = PartnetAdjacencyConstructor(m, store_bboxes=True)
+    # a.construct_adj_graph(num_workers=mp.cpu_count())
     d = PartnetAdjacencyDataset(m)
     for idx in range(len(d)):
         print([get_bbox_extent(bbox) for bbox in d[idx]])
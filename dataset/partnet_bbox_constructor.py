@@ -3,8 +3,9 @@ import sys
 
 BASE_PATH = os.path.dirname(__file__)
 sys.path.append(BASE_PATH)
-from dataset_util import Dataset
-from mesh_util import load_pc, get_pc, get_bbox, get_brect, get_bbox_extent, draw_boxes3d
+from dataset_util import Dataset, fork_pool, owner_method, close_pool
+from mesh_util import get_pc, load_merged_mesh, get_bbox, get_brect, get_bbox_extent, get_bbox_volumes, \
+    draw_boxes3d
 from partnet_config import cfg
 from partnet_meta_constructor import PartnetMetaConstructor
 from preprocess import *
@@ -12,58 +13,159 @@ from preprocess import *
 import trimesh
 import pymesh
 import random
+import time
 import numpy as np
 import pandas as pd
+import multiprocessing as mp
 
 from itertools import combinations
 from tqdm import tqdm
 
+# one record per part, row = part id; parts without a box keep NaN corners and valid=False.
+# aligned (padded to 352 bytes) so every float64 field of the memmap is 8-byte aligned
+BBOX_DTYPE = np.dtype([('corners', np.float64, (8, 3)), ('extents', np.float64, (3,)),
+                       ('transform', np.float64, (4, 4)), ('valid', np.bool_)], align=True)
+BBOX_STORE_NAME = 'bbox_store.npy'
 
 class PartnetBBoxConstructor():
-    def __init__(self, meta_constructor, bbox_dir=None):
+    # boxes go to <bbox_dir>/bbox_store.npy, a BBOX_DTYPE record array indexed by part id.
+    # the build runs in chunks of parts, <bbox_dir>/manifest.txt lists the global ids of every finished chunk
+    # (headed by the meta fingerprint) so an interrupted build resumes where it stopped.
+    # parts whose oriented box fails fall back to get_brect and are logged to <bbox_dir>/failures.txt
+    # obb_engine picks the oriented box fit of mesh_util.OBB_ENGINES, see obb_benchmark.py for speed and tightness
+    def __init__(self, meta_constructor, bbox_dir=None, obb_engine='trimesh'):
         self.meta_constructor = meta_constructor
         self.meta = self.meta_constructor.df
         self.parts = self.meta_constructor.parts
         self.part_parent_child = self.meta_constructor.part_parent_child
         self.part_sibling = self.meta_constructor.part_sibling
         self.part_leaf = self.meta_constructor.part_leaf
+        self.obj_table = self.meta_constructor.get_obj_table(self.parts.index)
 
         if bbox_dir is None:
             self.bbox_dir = cfg.bbox_dir
         else:
             self.bbox_dir = bbox_dir
-
-    @staticmethod
-    def _load_mesh(desc):
-        path = desc['objs_dir']
-        objs = desc['objs']
-        mesh_list = []
-        for obj in eval(objs):
-            obj_path = os.path.join(path, obj + '.obj')
-            mesh_tmp = load_pc(obj_path)
-            mesh_tmp, info = pymesh.remove_isolated_vertices(mesh_tmp)
-            mesh_list.append(mesh_tmp)
-        mesh = pymesh.merge_meshes(mesh_list)
-        return mesh
-
-    def construct_bbox(self, use_cache=True):
-        if use_cache:
+        self.obb_engine = obb_engine
+
+    def _load_mesh(self, part_id):
+        return load_merged_mesh(self.obj_table.get_paths(part_id))
+
+    def _construct_part(self, part_id):
+        # returns (bbox, extents, transform) and a failure message, or None as box when even the fallback failed
+        try:
+            part_mesh = self._load_mesh(part_id)
+        except Exception as e:
+            return None, "load: {!r}".format(e)
+        try:
+            bbox, extents, transform = get_bbox(part_mesh, engine=self.obb_engine)
+            return (bbox, extents, transform), None
+        except Exception as e:
+            failure = "get_bbox: {!r}".format(e)
+        try:
+            bbox, transform, extents = get_brect(part_mesh)
+        except Exception as e:
+            return None, failure + ", get_brect: {!r}".format(e)
+        return (bbox, extents, transform), failure + ", fell back to get_brect"
+
+    def _construct_chunk(self, part_ids):
+        # (part ids, BBOX_DTYPE records, [(global id, message)] of the failures) of the chunk
+        global_ids = self.parts['global_id'].to_numpy()[part_ids]
+        records = np.zeros(len(part_ids), dtype=BBOX_DTYPE)
+        records['corners'] = np.nan
+        failures = []
+        for i, (part_id, global_id) in enumerate(zip(part_ids, global_ids)):
+            box, failure = self._construct_part(part_id)
+            if failure is not None:
+                failures.append((global_id, failure))
+            if box is not None:
+                records[i] = (box[0], box[1], box[2], True)
+        return part_ids, records, failures
+
+    def _open_store(self, resume):
+        # (store, whether the existing store was reopened)
+        store_path = os.path.join(self.bbox_dir, BBOX_STORE_NAME)
+        if resume and os.path.exists(store_path):
+            store = np.lib.format.open_memmap(store_path, mode='r+')
+            if store.dtype == BBOX_DTYPE and store.shape == (len(self.parts),):
+                return store, True
+            del store
+        store = np.lib.format.open_memmap(store_path, mode='w+', dtype=BBOX_DTYPE, shape=(len(self.parts),))
+        store['corners'] = np.nan
+        return store, False
+
+    def _load_manifest(self):
+        # global ids finished by a previous run over the same meta
+        manifest_path = os.path.join(self.bbox_dir, 'manifest.txt')
+        if not os.path.exists(manifest_path):
+            return set()
+        with open(manifest_path) as f:
+            lines = f.read().split()
+        if len(lines) == 0 or lines[0] != self.meta_constructor.fingerprint:
+            return set()
+        return set(lines[1:])
+
+    def construct_bbox(self, use_cache=True, num_workers=0, chunksize=256):
+        # use_cache resumes from the manifest, otherwise every part is rebuilt
+        if not os.path.isdir(self.meta_constructor.path):
+            raise FileNotFoundError("dataset root {} is missing, the objs are read from it".format(
+                self.meta_constructor.path))
+        os.makedirs(self.bbox_dir, exist_ok=True)
+        manifest_path = os.path.join(self.bbox_dir, 'manifest.txt')
+        failure_path = os.path.join(self.bbox_dir, 'failures.txt')
+        if not use_cache and os.path.exists(manifest_path):
+            # a fresh build never resumes from the old manifest, even when it is interrupted before writing its own
+            os.remove(manifest_path)
+        finished = self._load_manifest()
+        store, resumed = self._open_store(resume=len(finished) > 0)
+        if not resumed:
+            finished = set()
+            with open(manifest_path, 'w') as f:
+                f.write(self.meta_constructor.fingerprint + '\n')
+            open(failure_path, 'w').close()
+
+        todo = np.flatnonzero(~self.parts['global_id'].isin(finished).to_numpy())
+        if len(todo) == 0:
             return None
-
-        for i in tqdm(range(len(self.parts))):
-            part_desc = self.parts.iloc[i]
-            part_global_id = part_desc['global_id']
-
-            part_mesh = self._load_mesh(part_desc)
-            try:
-                bbox, extents, transform = get_bbox(part_mesh)
-            except Exception as e:
-                bbox, extents, transform = get_brect(part_mesh)
-
-            np.savetxt(os.path.join(cfg.bbox_dir, part_global_id + '.txt'), bbox)
+        print(">>> Constructing BBoxes: {} of {} parts left".format(len(todo), len(self.parts)))
+        chunks = [todo[i:i + chunksize] for i in range(0, len(todo), chunksize)]
+        if num_workers > 0:
+            pool = fork_pool(self, num_workers)
+            results = pool.imap_unordered(owner_method('_construct_chunk'), chunks)
+        else:
+            pool = None
+            results = map(self._construct_chunk, chunks)
+
+        start = time.time()
+        num_failures = 0
+        try:
+            with open(manifest_path, 'a') as manifest, open(failure_path, 'a') as failure_log, \
+                    tqdm(total=len(todo), unit='part') as progress:
+                for part_ids, records, failures in results:
+                    for global_id, failure in failures:
+                        failure_log.write("{}\t{}\n".format(global_id, failure))
+                        tqdm.write(">>> BBox of {} failed: {}".format(global_id, failure))
+                    failure_log.flush()
+                    # the chunk only counts as finished once its boxes and then its ids reached the disk
+                    store[part_ids] = records
+                    store.flush()
+                    global_ids = self.parts['global_id'].to_numpy()[part_ids]
+                    manifest.write('\n'.join(global_ids) + '\n')
+                    manifest.flush()
+                    os.fsync(manifest.fileno())
+                    num_failures += len(failures)
+                    progress.update(len(global_ids))
+        finally:
+            close_pool(pool)
+            del store
+        elapsed = time.time() - start
+        print("=== Completed Constructing BBoxes: {} parts in {:.1f}s ({:.1f} parts/s), {} failures".format(
+            len(todo), elapsed, len(todo) / max(elapsed, 1e-6), num_failures))
 
 
 class PartnetBBoxDataset(Dataset):
+    # serves the (8, 3) corners from the memory-mapped bbox store, keyed by global id (get_mode 'global_id')
+    # or by part id; a list or array of keys returns the stacked (N, 8, 3) corners. failed parts read as NaN
     def __init__(self, meta_constructor, get_mode='global_id', bbox_dir=None):
         self.meta_constructor = meta_constructor
         self.meta = self.meta_constructor.df
@@ -75,23 +177,45 @@ class PartnetBBoxDataset(Dataset):
             self.bbox_dir = bbox_dir
 
         self.get_mode = get_mode
+        self.store = np.load(os.path.join(self.bbox_dir, BBOX_STORE_NAME), mmap_mode='r')
+        assert self.store.shape == (len(self.parts),), "bbox store was built for another meta, rebuild it"
+        assert self.store.dtype == BBOX_DTYPE, "bbox store has an old record layout, rebuild it"
+        self.bboxes = self.store['corners']
+        self.extents = self.store['extents']
+        self.transforms = self.store['transform']
+        self.valid = self.store['valid']
+        self.global_index = pd.Index(self.parts['global_id'])
+
+    def get_rows(self, item):
+        # part id(s) of a key or a list of keys
+        if self.get_mode != 'global_id':
+            return item if np.isscalar(item) else np.asarray(item, dtype=np.int64)
+        if isinstance(item, str):
+            return self.global_index.get_loc(item)
+        rows = self.global_index.get_indexer(list(item))
+        if np.any(rows < 0):
+            raise KeyError("unknown global ids {}".format([str(g) for g in np.asarray(item)[rows < 0]]))
+        return rows
 
     def _get_by_global_id(self, global_id):
         assert isinstance(global_id, str)
-        res = np.loadtxt(os.path.join(self.bbox_dir, global_id + '.txt'))
-        return res
+        return self.bboxes[self.global_index.get_loc(global_id)]
 
     def _get_by_index(self, index):
-        assert isinstance(index, int)
-        global_id = self.parts.iloc[index]['global_id']
-        res = np.loadtxt(os.path.join(self.bbox_dir, global_id + '.txt'))
-        return res
+        assert isinstance(index, (int, np.integer))
+        return self.bboxes[index]
+
+    def get_extents(self, item):
+        return self.extents[self.get_rows(item)]
+
+    def get_transforms(self, item):
+        return self.transforms[self.get_rows(item)]
+
+    def get_volumes(self, item):
+        return get_bbox_volumes(self[item])
 
     def __getitem__(self, item):
-        if self.get_mode == 'global_id':
-            return self._get_by_global_id(item)
-        else:
-            return self._get_by_index(item)
+        return self.bboxes[self.get_rows(item)]
 
     def __len__(self):
         return len(self.parts)
@@ -101,7 +225,7 @@ if __name__ == '__main__':
     m = PartnetMetaConstructor(cfg.partnet)
     m.construct_meta()
     a = PartnetBBoxConstructor(m)
-    a.construct_bbox()
+    a.construct_bbox(num_workers=mp.cpu_count())
     bd = PartnetBBoxDataset(m)
     print(bd['0_1'])
     print(get_bbox_extent(bd['0_1']))
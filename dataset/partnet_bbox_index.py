@@ -0,0 +1,238 @@
+import os
+import sys
+
+BASE_PATH = os.path.dirname(__file__)
+sys.path.append(BASE_PATH)
+from mesh_util import get_bbox_aabbs, get_aabb_distances_to
+from partnet_config import cfg
+from partnet_meta_constructor import PartnetMetaConstructor
+from partnet_bbox_constructor import PartnetBBoxDataset, BBOX_STORE_NAME
+from partnet_graph_store import write_packed, read_packed
+from gjk import gjk_calc
+
+import heapq
+import time
+import numpy as np
+
+BBOX_INDEX_NAME = 'bbox_index_{}.bin'
+
+
+def build_bvh(lo, hi, leaf_size=8):
+    # bounding volume hierarchy over N axis-aligned bounds, split top-down at the median center along the
+    # longest axis. node i covers node_lo[i]..node_hi[i]; inner nodes have children node_left/node_right,
+    # leaves (node_left == -1) hold the boxes order[node_start[i]:node_start[i] + node_count[i]]
+    centers = (lo + hi) / 2
+    order = np.arange(len(lo), dtype=np.int64)
+    node_lo, node_hi, node_left, node_right, node_start, node_count = [], [], [], [], [], []
+    stack = [(0, len(lo), -1, False)] if len(lo) > 0 else []
+    while stack:
+        start, end, parent, is_right = stack.pop()
+        node = len(node_lo)
+        if parent >= 0:
+            (node_right if is_right else node_left)[parent] = node
+        members = order[start:end]
+        node_lo.append(lo[members].min(axis=0))
+        node_hi.append(hi[members].max(axis=0))
+        node_left.append(-1)
+        node_right.append(-1)
+        node_start.append(start)
+        node_count.append(end - start)
+        if end - start <= leaf_size:
+            continue
+        spread = centers[members].max(axis=0) - centers[members].min(axis=0)
+        axis = np.argmax(spread)
+        mid = (end - start) // 2
+        order[start:end] = members[np.argpartition(centers[members, axis], mid)]
+        stack.append((start + mid, end, node, True))
+        stack.append((start, start + mid, node, False))
+    return {
+        'order': order,
+        'node_lo': np.array(node_lo, dtype=np.float64).reshape(-1, 3),
+        'node_hi': np.array(node_hi, dtype=np.float64).reshape(-1, 3),
+        'node_left': np.array(node_left, dtype=np.int64),
+        'node_right': np.array(node_right, dtype=np.int64),
+        'node_start': np.array(node_start, dtype=np.int64),
+        'node_count': np.array(node_count, dtype=np.int64),
+    }
+
+
+class PartnetBBoxIndexConstructor():
+    # BVH over the axis-aligned bounds of the valid boxes of the bbox store, part_mode 'leaf' indexes the leaves
+    # and 'all' every part. written to <bbox_dir>/bbox_index_<part_mode>.bin next to the bbox store and
+    # rebuilt whenever the meta or the bbox store changes
+    def __init__(self, meta_constructor, bbox_dir=None, part_mode='leaf', leaf_size=8):
+        self.meta_constructor = meta_constructor
+        self.part_index = self.meta_constructor.part_index
+        self.bbox_dataset = PartnetBBoxDataset(self.meta_constructor, get_mode='part_id', bbox_dir=bbox_dir)
+        self.bbox_dir = self.bbox_dataset.bbox_dir
+        assert part_mode in ('leaf', 'all')
+        self.part_mode = part_mode
+        self.leaf_size = leaf_size
+
+    def _get_info(self):
+        return {
+            'fingerprint': self.meta_constructor.fingerprint,
+            'bbox_mtime': os.path.getmtime(os.path.join(self.bbox_dir, BBOX_STORE_NAME)),
+            'part_mode': self.part_mode,
+            'leaf_size': self.leaf_size,
+        }
+
+    def construct_index(self, use_cache=True):
+        index_path = os.path.join(self.bbox_dir, BBOX_INDEX_NAME.format(self.part_mode))
+        info = self._get_info()
+        if use_cache and os.path.exists(index_path) and read_packed(index_path)[0] == info:
+            return None
+
+        start = time.time()
+        part_ids = self.part_index.leaf_ids if self.part_mode == 'leaf' else np.arange(self.part_index.num_parts)
+        part_ids = part_ids[self.bbox_dataset.valid[part_ids]]
+        print(">>> Constructing BBox Index: {} boxes".format(len(part_ids)))
+        lo, hi = get_bbox_aabbs(self.bbox_dataset[part_ids])
+        arrays = build_bvh(lo, hi, self.leaf_size)
+        # boxes are stored in tree order, a leaf node reads one contiguous range
+        order = arrays.pop('order')
+        arrays['part_ids'] = part_ids[order]
+        arrays['box_lo'] = lo[order]
+        arrays['box_hi'] = hi[order]
+        write_packed(index_path, arrays, info)
+        print("=== Completed Constructing BBox Index: {} nodes in {:.1f}s".format(
+            len(arrays['node_lo']), time.time() - start))
+
+
+class PartnetBBoxIndex():
+    # k-nearest and radius queries over the part boxes. the BVH only prunes with axis-aligned bounds, every
+    # reported distance is the exact box distance of gjk_calc. a query is a global id, a part id or (8, 3) corners;
+    # scope 'all' searches every indexed part, 'item' only the parts of the item of the query part.
+    # results are (part ids, distances) sorted by distance, the query part itself is left out
+    def __init__(self, meta_constructor, bbox_dir=None, part_mode='leaf'):
+        self.meta_constructor = meta_constructor
+        self.parts = self.meta_constructor.parts
+        self.part_index = self.meta_constructor.part_index
+        self.bbox_dataset = PartnetBBoxDataset(self.meta_constructor, get_mode='part_id', bbox_dir=bbox_dir)
+        self.part_mode = part_mode
+
+        index_path = os.path.join(self.bbox_dataset.bbox_dir, BBOX_INDEX_NAME.format(part_mode))
+        self.info, arrays = read_packed(index_path)
+        # a stale index would prune with old bounds while the exact distances come from the new boxes.
+        # a meta without fingerprint skips that check, as PartnetGraphStore does
+        fingerprint = self.meta_constructor.fingerprint
+        if fingerprint is not None and self.info['fingerprint'] != fingerprint:
+            raise ValueError("bbox index was built for another meta, rebuild it")
+        if self.info['bbox_mtime'] != os.path.getmtime(os.path.join(self.bbox_dataset.bbox_dir, BBOX_STORE_NAME)):
+            raise ValueError("bbox store changed since the bbox index was built, rebuild it")
+        if self.info['part_mode'] != part_mode:
+            raise ValueError("bbox index was built for part_mode {}".format(self.info['part_mode']))
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+
+    def _get_query(self, query):
+        # (part id or -1, (8, 3) corners)
+        if isinstance(query, str):
+            part_id = self.bbox_dataset.global_index.get_loc(query)
+        elif np.isscalar(query):
+            part_id = int(query)
+        else:
+            return -1, np.asarray(query, dtype=np.float64).reshape(8, 3)
+        if not self.bbox_dataset.valid[part_id]:
+            raise ValueError("part {} has no box".format(self.parts['global_id'].iloc[part_id]))
+        return part_id, np.asarray(self.bbox_dataset[part_id])
+
+    def _get_item_parts(self, part_id):
+        if part_id < 0:
+            raise ValueError("scope 'item' needs a part as query, not corners")
+        item_id = self.parts['item_id'].iloc[part_id]
+        if self.part_mode == 'leaf':
+            part_ids = self.part_index.leafs_of_items([item_id])
+        else:
+            part_ids = self.part_index.parts_of_items([item_id])
+        return part_ids[self.bbox_dataset.valid[part_ids] & (part_ids != part_id)]
+
+    def _exact(self, corners, part_ids):
+        # gjk distances between the query corners and the boxes of part_ids
+        if len(part_ids) == 0:
+            return np.zeros(0)
+        boxes = np.concatenate([corners[None], self.bbox_dataset[part_ids]])
+        pairs = np.stack([np.zeros(len(part_ids), dtype=np.int64), np.arange(1, len(part_ids) + 1)], axis=1)
+        return gjk_calc.calc_pairs(boxes, pairs).distance
+
+    def _sorted(self, part_ids, distances, k=None):
+        order = np.argsort(distances, kind='stable')[:k]
+        return np.asarray(part_ids, dtype=np.int64)[order], np.asarray(distances)[order]
+
+    def radius(self, query, radius, scope='all'):
+        # parts within radius of the query box
+        part_id, corners = self._get_query(query)
+        query_lo, query_hi = get_bbox_aabbs(corners)
+        if scope == 'item':
+            part_ids = self._get_item_parts(part_id)
+            distances = self._exact(corners, part_ids)
+            return self._sorted(part_ids[distances <= radius], distances[distances <= radius])
+
+        # walk the tree a level at a time, keeping the nodes whose bounds come within radius
+        frontier = np.zeros(min(len(self.node_lo), 1), dtype=np.int64)
+        leaves = []
+        while len(frontier) > 0:
+            frontier = frontier[get_aabb_distances_to(self.node_lo[frontier], self.node_hi[frontier],
+                                                      query_lo, query_hi) <= radius]
+            is_leaf = self.node_left[frontier] < 0
+            leaves.append(frontier[is_leaf])
+            frontier = np.concatenate([self.node_left[frontier[~is_leaf]], self.node_right[frontier[~is_leaf]]])
+        leaves = np.concatenate(leaves) if leaves else np.zeros(0, dtype=np.int64)
+        counts = self.node_count[leaves]
+        rows = np.arange(counts.sum()) + np.repeat(self.node_start[leaves] - (np.cumsum(counts) - counts), counts)
+        rows = rows[get_aabb_distances_to(self.box_lo[rows], self.box_hi[rows], query_lo, query_hi) <= radius]
+        part_ids = np.asarray(self.part_ids[rows])
+        part_ids = part_ids[part_ids != part_id]
+        distances = self._exact(corners, part_ids)
+        return self._sorted(part_ids[distances <= radius], distances[distances <= radius])
+
+    def knn(self, query, k, scope='all'):
+        # the k parts closest to the query box
+        if k < 1:
+            raise ValueError("k must be at least 1, got {}".format(k))
+        part_id, corners = self._get_query(query)
+        query_lo, query_hi = get_bbox_aabbs(corners)
+        if scope == 'item':
+            part_ids = self._get_item_parts(part_id)
+            return self._sorted(part_ids, self._exact(corners, part_ids), k)
+
+        # best-first over the nodes by bound distance, stops once no node can beat the k-th exact distance
+        part_ids, distances = [], []
+        kth = np.inf
+        heap = [(0.0, 0)] if len(self.node_lo) > 0 else []
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if bound > kth:
+                break
+            if self.node_left[node] >= 0:
+                children = np.array([self.node_left[node], self.node_right[node]])
+                bounds = get_aabb_distances_to(self.node_lo[children], self.node_hi[children], query_lo, query_hi)
+                for child_bound, child in zip(bounds, children):
+                    if child_bound <= kth:
+                        heapq.heappush(heap, (child_bound, child))
+                continue
+            rows = np.arange(self.node_start[node], self.node_start[node] + self.node_count[node])
+            bounds = get_aabb_distances_to(self.box_lo[rows], self.box_hi[rows], query_lo, query_hi)
+            candidates = np.asarray(self.part_ids[rows[bounds <= kth]])
+            candidates = candidates[candidates != part_id]
+            part_ids.append(candidates)
+            distances.append(self._exact(corners, candidates))
+            if sum(len(d) for d in distances) >= k:
+                kth = np.partition(np.concatenate(distances), k - 1)[k - 1]
+        if len(part_ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        return self._sorted(np.concatenate(part_ids), np.concatenate(distances), k)
+
+    def get_global_ids(self, part_ids):
+        return self.parts['global_id'].to_numpy()[part_ids]
+
+
+if __name__ == '__main__':
+    m = PartnetMetaConstructor(cfg.partnet)
+    m.construct_meta()
+    PartnetBBoxIndexConstructor(m).construct_index()
+    bi = PartnetBBoxIndex(m)
+    # all leaves within 5 cm of a part, then its 5 nearest leaves over all instances and within its own
+    print(bi.get_global_ids(bi.radius('0_1', 0.05)[0]))
+    print(bi.knn('0_1', 5))
+    print(bi.knn('0_1', 5, scope='item'))
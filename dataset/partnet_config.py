@@ -20,7 +20,18 @@ __C.parts_columns = ['global_id', 'item_id', 'part_relative_id', 'name', 'text',
 __C.part_parent_child_columns = ['parent_global_id', 'child_global_id']
 __C.part_sibling_columns = ['sibling_a_id', 'sibling_b_id']
 __C.part_leaf_columns = ['leaf_global_id']
+__C.mtime_columns = ['dirname', 'item_id', 'meta_mtime', 'result_mtime']
+
+# bump whenever the layout of the meta cache changes
+__C.meta_cache_version = 4
 
 # Adj Graph Dir
 __C.graph_dir = "/disk1/data/xinyu/partnet_graph_dir"
 __C.bbox_dir = "/disk1/data/xinyu/partnet_bbox_dir"
+
+# Packed mesh store, one sub directory per category
+__C.mesh_store_dir = "/disk1/data/xinyu/partnet_mesh_store"
+
+# Packed instance point clouds, indexed by item id
+__C.pc_store_dir = "/disk1/data/xinyu/partnet_pc_store"
+__C.pc_store_points = 10000
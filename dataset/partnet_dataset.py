@@ -3,11 +3,16 @@ import sys
 
 BASE_PATH = os.path.dirname(__file__)
 sys.path.append(BASE_PATH)
-from dataset_util import Dataset
-from mesh_util import load_pc, get_pc
+from dataset_util import Dataset, fork_pool, owner_method, close_pool
+from mesh_util import load_pc, get_pc, load_merged_mesh
 from partnet_config import cfg
+from cache_util import make_cache
 from partnet_meta_constructor import PartnetMetaConstructor
+from partnet_mesh_store import PartnetMeshStore
+from partnet_pc_store import PartnetPointCloudStore
 from preprocess import *
+from sampler import RandomSampler
+from batch_ring import BatchRing, SlotRef, get_slot_spec
 
 import trimesh
 import pymesh
@@ -15,14 +20,19 @@ import random
 import numpy as np
 import pandas as pd
 import threading
-from queue import Queue
+import asyncio
+from queue import Queue, Empty, Full
+from collections import deque
 import multiprocessing as mp
 from tqdm import tqdm
 
 
 class PartnetDataset(Dataset):
-    def __init__(self, path=None, cat=None, cache_maxsize=None,
-                 traverse="instance", return_mode="vertex"):
+    def __init__(self, path=None, cat=None, cache_maxsize=None, cache_maxbytes=None, cache_policy="lru",
+                 traverse="instance", return_mode="vertex", backend="obj", store_dir=None, pc_store_dir=None,
+                 shared_cache_dir=None):
+        # backend "obj" parses the PartNet obj/ply files, "store" reads the packed stores built offline
+        # cache_policy "shared" shares decoded meshes between all processes of the node through shared_cache_dir
         self.meta_constructor = PartnetMetaConstructor(path)
         self.meta_constructor.construct_meta()
         self.meta = self.meta_constructor.df
@@ -30,131 +40,142 @@ class PartnetDataset(Dataset):
         self.part_parent_child = self.meta_constructor.part_parent_child
         self.part_sibling = self.meta_constructor.part_sibling
         self.part_leaf = self.meta_constructor.part_leaf
+        self.part_index = self.meta_constructor.part_index
         self.length = len(self.meta)
         self.length_part = len(self.parts)
         self.cat = cat
         self.traverse = traverse
         self.return_mode = return_mode
-        self.cache = {}
+        self.backend = backend
+        self.store_dir = store_dir
+        self.pc_store_dir = pc_store_dir
+        self.mesh_store = None
+        self.pc_store = None
+        if self.backend == 'store':
+            self.pc_store = PartnetPointCloudStore(self.meta_constructor.fingerprint, self.pc_store_dir)
         self.cache_maxsize = cache_maxsize
+        self.cache_maxbytes = cache_maxbytes
+        if cache_policy == 'shared':
+            namespace = self.meta_constructor.fingerprint or 'default'
+            self.cache = make_cache(cache_policy, maxsize=cache_maxsize, maxbytes=cache_maxbytes,
+                                    root=shared_cache_dir, namespace=namespace[:16])
+        else:
+            self.cache = make_cache(cache_policy, maxsize=cache_maxsize, maxbytes=cache_maxbytes)
+        self.cache_scope = None
 
         self.reload_category(self.cat)
 
     def reload_category(self, cat=None):
         # self.meta_in_action is a view of self.meta
+        self.cat = cat
         if cat is not None:
-            if isinstance(cat, str):
-                self.meta_in_action = self.meta[self.meta['cat'] == cat]
-            else:
-                self.meta_in_action = self.meta[self.meta['cat'].isin(cat)]
+            self.meta_in_action = self.meta.iloc[self._get_item_ids_from_cat(cat)]
             self.parts_in_action = self._get_parts_from_cat(cat)
             self.leafs_in_action = self._get_leafs_from_cat(cat)
         else:
             self.meta_in_action = self.meta
             self.parts_in_action = self.parts
             self.leafs_in_action = self._get_leafs_from_cat(None)
+        if self.backend == 'store':
+            self.mesh_store = PartnetMeshStore(self._get_cat_list(cat), self.meta_constructor.fingerprint,
+                                               self.store_dir)
         self.reload_traverse(self.traverse)
 
     def reload_traverse(self, traverse):
         self.traverse = traverse
+        self.item_ids = self.meta_in_action.index.to_numpy()
         if self.traverse == 'instance':
             self.length_in_action = len(self.meta_in_action)
-        elif self.traverse == 'part':
-            self.length_in_action = len(self.parts_in_action)
+            self.model_paths = self.meta_in_action['model_path'].to_numpy()
         else:
-            self.length_in_action = len(self.leafs_in_action)
-        self.cache = {}
+            parts_in_action = self.parts_in_action if self.traverse == 'part' else self.leafs_in_action
+            self.length_in_action = len(parts_in_action)
+            self.part_ids = parts_in_action.index.to_numpy()
+            if self.backend == 'store':
+                self.leaf_offsets, self.leaf_ids = self.part_index.leafs_of_parts(parts_in_action.index)
+            else:
+                self.obj_table = self.meta_constructor.get_obj_table(parts_in_action.index)
+
+        # entries are keyed by (traverse, item or part id), keep them while the scope is unchanged
+        cache_scope = (self.traverse, self.cat if self.cat is None or isinstance(self.cat, str) else tuple(self.cat))
+        if cache_scope != self.cache_scope:
+            self.cache.clear()
+            self.cache_scope = cache_scope
 
     def _get_part_id_from_item_id(self, item_id):
-        return list(self.parts[self.parts['item_id'] == item_id]['global_id'])
+        return list(self.parts['global_id'].iloc[self.part_index.parts_of_items([item_id])])
 
-    def _get_parts_from_cat(self, cat):
+    def get_item_ids(self):
+        # item id of every index of the current traversal
+        if self.traverse == 'instance':
+            return self.item_ids
+        return self.parts['item_id'].to_numpy()[self.part_ids]
+
+    def get_categories(self):
+        # category of every index of the current traversal
+        return self.meta['cat'].to_numpy()[self.get_item_ids()]
+
+    def _get_cat_list(self, cat):
+        if cat is None:
+            return sorted(self.meta['cat'].unique())
+        elif isinstance(cat, str):
+            return [cat]
+        else:
+            return list(cat)
+
+    def _get_item_ids_from_cat(self, cat):
         if isinstance(cat, str):
-            item_ids = list(self.meta[self.meta['cat'] == cat].index)
+            return np.flatnonzero((self.meta['cat'] == cat).to_numpy())
         else:
-            item_ids = list(self.meta[self.meta['cat'].isin(cat)].index)
-        return self.parts[self.parts['item_id'].isin(item_ids)]
+            return np.flatnonzero(self.meta['cat'].isin(cat).to_numpy())
+
+    def _get_parts_from_cat(self, cat):
+        return self.parts.iloc[self.part_index.parts_of_items(self._get_item_ids_from_cat(cat))]
 
     def _get_leafs_from_cat(self, cat):
         if cat is None:
-            return self.parts[self.parts['global_id'].isin(self.part_leaf['leaf_global_id'])]
+            return self.parts.iloc[self.part_index.leaf_ids]
         else:
-            if isinstance(cat, str):
-                item_ids = list(self.meta[self.meta['cat'] == cat].index)
-            else:
-                item_ids = list(self.meta[self.meta['cat'].isin(cat)].index)
-            global_ids = self.parts[self.parts['item_id'].isin(item_ids)]['global_id']
-            leaf_global_ids = self.part_leaf[self.part_leaf['leaf_global_id'].isin(global_ids)]['leaf_global_id']
-            return self.parts[self.parts['global_id'].isin(leaf_global_ids)]
+            return self.parts.iloc[self.part_index.leafs_of_items(self._get_item_ids_from_cat(cat))]
 
-    def _getitem_instance(self, index):
-        if index in self.cache:
-            # print("!!!CACHED")
-            mesh = self.cache[index]
-        else:
-            path = self.meta_in_action.iloc[index]['model_path']
-            mesh = load_pc(path)
-            if len(self.cache) == self.cache_maxsize:
-                pop_key = random.choice(list(self.cache.keys()))
-                self.cache.pop(pop_key)
-                # print("pop", pop_key)
-            self.cache[index] = mesh
-            # print("ins", index)
+    def _load_part_mesh(self, index):
+        if self.backend == 'store':
+            return self.mesh_store.get_merged(self.leaf_ids[self.leaf_offsets[index]:self.leaf_offsets[index + 1]])
+        return load_merged_mesh(self.obj_table.get_paths(index))
 
+    def _get_return(self, mesh):
         if self.return_mode == "vertex":
             res = get_pc(mesh)
         else:
             res = mesh
         return res
 
-    def _getitem_part(self, index):
-        if index in self.cache:
-            mesh = self.cache[index]
-        else:
-            path = self.parts_in_action.iloc[index]['objs_dir']
-            objs = self.parts_in_action.iloc[index]['objs']
-            mesh_list = []
-            for obj in eval(objs):
-                obj_path = os.path.join(path, obj + '.obj')
-                mesh_tmp = load_pc(obj_path)
-                mesh_tmp, info = pymesh.remove_isolated_vertices(mesh_tmp)
-                mesh_list.append(mesh_tmp)
-
-            mesh = pymesh.merge_meshes(mesh_list)
-            if len(self.cache) == self.cache_maxsize:
-                pop_key = random.choice(list(self.cache.keys()))
-                self.cache.pop(pop_key)
-            self.cache[index] = mesh
+    def _getitem_instance(self, index):
+        key = ('instance', self.item_ids[index])
+        mesh = self.cache.get(key)
+        if mesh is None:
+            if self.backend == 'store':
+                mesh = self.pc_store[self.item_ids[index]]
+            else:
+                mesh = load_pc(self.model_paths[index])
+            self.cache.put(key, mesh)
+        return self._get_return(mesh)
 
-        if self.return_mode == "vertex":
-            res = get_pc(mesh)
-        else:
-            res = mesh
-        return res
+    def _getitem_part(self, index):
+        key = ('part', self.part_ids[index])
+        mesh = self.cache.get(key)
+        if mesh is None:
+            mesh = self._load_part_mesh(index)
+            self.cache.put(key, mesh)
+        return self._get_return(mesh)
 
     def _getitem_leaf(self, index):
-        if index in self.cache:
-            mesh = self.cache[index]
-        else:
-            path = self.leafs_in_action.iloc[index]['objs_dir']
-            objs = self.leafs_in_action.iloc[index]['objs']
-            mesh_list = []
-            for obj in eval(objs):
-                obj_path = os.path.join(path, obj + '.obj')
-                mesh_tmp = load_pc(obj_path)
-                mesh_tmp, info = pymesh.remove_isolated_vertices(mesh_tmp)
-                mesh_list.append(mesh_tmp)
-            mesh = pymesh.merge_meshes(mesh_list)
-            if len(self.cache) == self.cache_maxsize:
-                pop_key = random.choice(list(self.cache.keys()))
-                self.cache.pop(pop_key)
-            self.cache[index] = mesh
-
-        if self.return_mode == "vertex":
-            res = get_pc(mesh)
-        else:
-            res = mesh
-        return res
+        key = ('leaf', self.part_ids[index])
+        mesh = self.cache.get(key)
+        if mesh is None:
+            mesh = self._load_part_mesh(index)
+            self.cache.put(key, mesh)
+        return self._get_return(mesh)
 
     def __getitem__(self, index):
         if self.traverse == 'instance':
@@ -168,57 +189,302 @@ class PartnetDataset(Dataset):
         return self.length_in_action
 
 
+def _init_loader_worker(seed, counter):
+    # every worker gets its own random stream, forked workers would otherwise share the parent state
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+    if seed is None:
+        np.random.seed()
+        seed_rng()
+    else:
+        np.random.seed((seed + worker_id) % 2 ** 32)
+        seed_rng([seed, worker_id])
+
+
+def _set_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class EpochEnd(object):
+    # queued after the last batch of an epoch when the loader is created with epoch_marker=True
+    def __init__(self, epoch):
+        self.epoch = epoch
+
+
 class PartnetDataLoader(threading.Thread):
     def __init__(self, dataset, batch_size=32, max_epoch=200, queue_maxsize=500, aligned=True,
-                 preprocess_callback_list=(identity,)):
+                 preprocess_callback_list=(identity,), num_workers=0, ordered=True, prefetch_batches=None,
+                 seed=None, sampler=None, epoch_marker=False, collate_fn=None, ring_slots=None):
+        # num_workers > 0 loads batches in a forked process pool, ordered=False delivers them as they complete
+        # max_epoch=None loops forever, otherwise fetch returns None once max_epoch epochs were delivered
+        # collate_fn turns the preprocessed samples of a batch into one batch (see collate.py), needed for
+        # variable-size samples with batch_size > 1; otherwise aligned samples are stacked
+        # ring_slots delivers batches through that many preallocated slots (shared with the workers) instead of
+        # queueing fresh arrays; batch shapes must be fixed, and a fetched batch is only valid until the next fetch
         super(PartnetDataLoader, self).__init__()
+        self.daemon = True
         self.dataset = dataset
         self.dataset_len = len(self.dataset)
         self.batch_size = batch_size
         self.max_epoch = max_epoch
+        self.epoch = 0
+        if sampler is None:
+            sampler = RandomSampler(dataset, seed=seed)
+        self.sampler = sampler
+        self.epoch_marker = epoch_marker
+        self.exhausted = False
+        self.error = None
         self.num_batches = self.dataset_len // self.batch_size
         self.aligned = aligned
         self.preprocess_callback_list = list(preprocess_callback_list)
+        self.num_workers = num_workers
+        self.ordered = ordered
+        if prefetch_batches is None:
+            self.prefetch_batches = 2 * num_workers
+        else:
+            self.prefetch_batches = prefetch_batches
+        self.seed = seed
+        self.pool = None
+        self.collate_fn = collate_fn
+        self.ring_slots = ring_slots
+        self.ring = None
+        self.held = None
+        if collate_fn is None and not aligned and batch_size != 1:
+            raise ValueError("unaligned batches of size {} need a collate_fn".format(batch_size))
+
+        # in-process collators reusing their buffers must not overwrite batches that are still queued or held
+        # by the consumer, worker results are copies and do not share buffers
+        num_buffers = getattr(collate_fn, 'num_buffers', None)
+        if num_buffers is not None and num_workers == 0 and ring_slots is None:
+            queue_maxsize = min(queue_maxsize, num_buffers - 1 - len(self.preprocess_callback_list))
+            if queue_maxsize < 1:
+                raise ValueError("collate_fn needs at least {} buffers".format(len(self.preprocess_callback_list) + 2))
 
         self.queue = Queue(maxsize=queue_maxsize)
         self.stopped = False
+        # (event loop, future) of every afetch waiting for the producer
+        self.waiters = []
+        self.waiters_lock = threading.Lock()
+
+    def start(self):
+        # fork from the calling thread rather than from the loader thread
+        if self.ring_slots is not None:
+            # one probe batch fixes the slot shapes, the ring has to exist before the workers fork
+            probe = self._load_batch(np.arange(self.batch_size) % self.dataset_len)
+            self.ring = BatchRing(self.ring_slots, get_slot_spec(probe), shared=self.num_workers > 0)
+            print(">>> Allocated {} Ring Slots: {:.1f} MB".format(self.ring_slots, self.ring.nbytes / 2 ** 20))
+        if self.num_workers > 0:
+            self.pool = fork_pool(self, self.num_workers, initializer=_init_loader_worker,
+                                  initargs=(self.seed, mp.Value('i', 0)))
+        super(PartnetDataLoader, self).start()
+
+    def _load_batch(self, indices, batch_seed=None, slot=None):
+        # with a loader seed every batch reseeds the generator, so results do not depend on the worker
+        if batch_seed is not None:
+            seed_rng(batch_seed)
+        pc_list = []
+        for i in indices:
+            pc_list.append(self.dataset[i])
+        # vanilla = self.concat_pc(pc_list)
+
+        res_list = []
+        for ppf in self.preprocess_callback_list:
+            if getattr(ppf, 'batched', False):
+                res_list.append(ppf(pc_list))
+                continue
+            mapped = list(map(ppf, pc_list))
+            if self.collate_fn is not None:
+                res_list.append(self.collate_fn(mapped))
+            elif self.aligned:
+                res_list.append(self.concat_pc(mapped))
+            elif self.batch_size == 1:
+                res_list.append(mapped[0])
+        if slot is not None:
+            # written in place, only the slot id has to travel back from a worker
+            self.ring.write(slot, res_list)
+            return slot
+        return res_list
+
+    def _acquire_slot(self, block=True):
+        # None once the loader stops, or right away when block=False and every slot is taken
+        while not self.stopped:
+            try:
+                return self.ring.acquire(timeout=0.1 if block else 0)
+            except Empty:
+                if not block:
+                    return None
+        return None
 
-    def run(self):
+    def _wait(self, async_result):
         while not self.stopped:
-            self.dataset_len = len(self.dataset)
-            index_mapping = np.arange(self.dataset_len)
-            np.random.shuffle(index_mapping)
-            self.num_batches = self.dataset_len // self.batch_size
+            try:
+                return async_result.get(timeout=0.1)
+            except mp.TimeoutError:
+                continue
+        return None
+
+    def _iter_batches(self, batch_indices):
+        if self.pool is None:
+            for task in batch_indices:
+                if self.ring is None:
+                    yield self._load_batch(*task)
+                    continue
+                slot = self._acquire_slot()
+                if slot is None:
+                    return
+                yield self.ring.refs_of(self._load_batch(*task, slot=slot))
+            return
+
+        # keep at most prefetch_batches in flight so results cannot pile up behind a slow consumer
+        batch_indices = iter(batch_indices)
+        task = None
+        pending = deque()
+        done = None if self.ordered else Queue()
+        while not self.stopped:
+            while len(pending) < max(1, self.prefetch_batches):
+                if task is None:
+                    task = next(batch_indices, None)
+                    if task is None:
+                        break
+                slot = None
+                if self.ring is not None:
+                    # only block for a slot when nothing is in flight, finished batches must keep flowing
+                    slot = self._acquire_slot(block=len(pending) == 0)
+                    if slot is None:
+                        break
+                if self.ordered:
+                    # ordered mode waits on the handles themselves, nothing may collect the results elsewhere
+                    pending.append(self.pool.apply_async(owner_method('_load_batch'), task + (slot,)))
+                else:
+                    pending.append(self.pool.apply_async(owner_method('_load_batch'), task + (slot,),
+                                                         callback=done.put, error_callback=done.put))
+                task = None
+            if len(pending) == 0:
+                return
+            if self.ordered:
+                res_list = self._wait(pending.popleft())
+            else:
+                res_list = None
+                while not self.stopped:
+                    try:
+                        res_list = done.get(timeout=0.1)
+                        break
+                    except Empty:
+                        continue
+                if isinstance(res_list, BaseException):
+                    raise res_list
+                # results arrive through the callback, the handles only count the batches in flight
+                pending.popleft()
+            if res_list is not None:
+                yield res_list if self.ring is None else self.ring.refs_of(res_list)
+
+    def _put(self, res):
+        while not self.stopped:
+            try:
+                self.queue.put(res, timeout=0.1)
+                self._wake_waiters()
+                return True
+            except Full:
+                continue
+        return False
+
+    def _wake_waiters(self):
+        with self.waiters_lock:
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_set_waiter, future)
+            except RuntimeError:
+                # the loop of that waiter was closed meanwhile
+                continue
 
-            for batch_idx in range(self.num_batches):
-                if self.stopped:
-                    return None
+    def run(self):
+        try:
+            self._run()
+        except Exception as exc:
+            # hand the failure over to the consumer instead of leaving it blocked on fetch
+            self.error = exc
+            self._put(None)
+
+    def _run(self):
+        while not self.stopped and (self.max_epoch is None or self.epoch < self.max_epoch):
+            self.sampler.set_epoch(self.epoch)
+            index_mapping = np.asarray(self.sampler.get_indices(), dtype=np.int64)
+            self.dataset_len = len(index_mapping)
+            self.num_batches = self.dataset_len // self.batch_size
 
-                start_idx = batch_idx * self.batch_size
-                end_idx = (batch_idx + 1) * self.batch_size
-
-                pc_list = []
-                for i in range(start_idx, end_idx):
-                    pc_list.append(self.dataset[i])
-                # vanilla = self.concat_pc(pc_list)
-                # self.queue.put(vanilla)
-
-                for ppf in self.preprocess_callback_list:
-                    mapped = list(map(ppf, pc_list))
-                    if self.aligned:
-                        res_mapped = self.concat_pc(mapped)
-                    elif self.batch_size == 1:
-                        res_mapped = mapped[0]
-                    self.queue.put(res_mapped)
-
-    def fetch(self):
-        if self.stopped:
+            batch_indices = [(index_mapping[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size],
+                              None if self.seed is None else [self.seed, self.epoch, batch_idx])
+                             for batch_idx in range(self.num_batches)]
+            for res_list in self._iter_batches(batch_indices):
+                for res in res_list:
+                    if not self._put(res):
+                        return None
+            self.epoch += 1
+            if self.epoch_marker and not self._put(EpochEnd(self.epoch - 1)):
+                return None
+        # end of data
+        self._put(None)
+
+    def fetch(self, timeout=None):
+        # timeout=None blocks, otherwise queue.Empty is raised when no batch arrives within timeout seconds
+        # fetching hands the slot of the previous ring batch back to the producer
+        if self.held is not None:
+            self.ring.release(self.held)
+            self.held = None
+        if self.stopped or self.exhausted:
             return None
-        return self.queue.get()
+        if timeout == 0:
+            res = self.queue.get_nowait()
+        else:
+            res = self.queue.get(timeout=timeout)
+        if res is None:
+            self.exhausted = True
+            if self.error is not None:
+                raise self.error
+        if isinstance(res, SlotRef):
+            self.held = res
+            return self.ring.read(res)
+        return res
+
+    async def afetch(self):
+        # fetch for asyncio consumers, waits on the event loop instead of blocking a thread
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return self.fetch(timeout=0)
+            except Empty:
+                pass
+            future = loop.create_future()
+            with self.waiters_lock:
+                self.waiters.append((loop, future))
+            # the producer may have queued a batch between the check and the registration
+            if not self.queue.empty() or self.stopped:
+                continue
+            await future
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        res = await self.afetch()
+        if res is None:
+            raise StopAsyncIteration
+        return res
 
     def shutdown(self):
         self.stopped = True
+        self._wake_waiters()
         print(">>> Shutting Down Dataloader")
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        if self.pool is not None:
+            # the loader thread stopped submitting, at most prefetch_batches batches are left to finish
+            close_pool(self.pool, wait=True)
+            self.pool = None
+            print("=== Shut Down Dataloader: Workers Stopped")
         while not self.queue.empty():
             self.queue.get()
         print("=== Shut Down Dataloader: All Queued Data Cleared")
@@ -229,18 +495,12 @@ class PartnetDataLoader(threading.Thread):
         return res
 
     def _benchmark_compare(self, batch_idx):
-        start_idx = batch_idx * self.batch_size
-        end_idx = (batch_idx + 1) * self.batch_size
-
-        pc_list = []
-        for i in range(start_idx, end_idx):
-            pc_list.append(self.dataset[i])
-
-        ppf = self.preprocess_callback_list[0]
-        mapped = list(map(ppf, pc_list))
-        res_mapped = self.concat_pc(mapped)
-
-        return res_mapped
+        # batch batch_idx of the current epoch built in the calling thread, through the sampler and _load_batch
+        # like every delivered batch, so batched preprocessors get the whole batch
+        index_mapping = np.asarray(self.sampler.get_indices(), dtype=np.int64)
+        indices = index_mapping[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size]
+        res_list = self._load_batch(indices, None if self.seed is None else [self.seed, self.epoch, batch_idx])
+        return res_list[0]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+import os
+import sys
+
+BASE_PATH = os.path.dirname(__file__)
+sys.path.append(BASE_PATH)
+from partnet_config import cfg
+
+import json
+import numpy as np
+from collections import namedtuple
+
+GRAPH_STORE_NAME = 'graph_store.bin'
+PACKED_MAGIC = b'PNPACK01'
+PACKED_ALIGN = 64
+
+# graph of one item: leaf i is part leaf_ids[i], its edges are indices[indptr[i]:indptr[i + 1]] (local leaf indices)
+# with the box distances; directional marks the edges running from the larger to the smaller box
+PartnetGraph = namedtuple('PartnetGraph', ['leaf_ids', 'indptr', 'indices', 'distances', 'directional'])
+
+
+def write_packed(path, arrays, info):
+    # several arrays in one file: magic, json header length (uint64), json header, then the 64-byte aligned
+    # array data; info is stored in the header next to the dtype, shape and offset of every array.
+    # written to a temporary file and renamed, readers never see a partial file
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    sections = {}
+    offset = 0
+    for name, arr in arrays.items():
+        offset = -(-offset // PACKED_ALIGN) * PACKED_ALIGN
+        sections[name] = [arr.dtype.str, list(arr.shape), offset]
+        offset += arr.nbytes
+    header = json.dumps({'info': info, 'sections': sections}).encode()
+    data_start = -(-(len(PACKED_MAGIC) + 8 + len(header)) // PACKED_ALIGN) * PACKED_ALIGN
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as stream:
+        stream.write(PACKED_MAGIC)
+        stream.write(np.uint64(len(header)).tobytes())
+        stream.write(header)
+        for name, arr in arrays.items():
+            stream.seek(data_start + sections[name][2])
+            stream.write(arr.tobytes())
+        stream.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_packed(path):
+    # (info, {name: read-only memmap}) of a file written by write_packed
+    with open(path, 'rb') as stream:
+        magic = stream.read(len(PACKED_MAGIC))
+        if magic != PACKED_MAGIC:
+            raise ValueError("{} is not a packed array file".format(path))
+        header_len = int(np.frombuffer(stream.read(8), dtype=np.uint64)[0])
+        header = json.loads(stream.read(header_len).decode())
+    data_start = -(-(len(PACKED_MAGIC) + 8 + header_len) // PACKED_ALIGN) * PACKED_ALIGN
+    arrays = {}
+    for name, (dtype, shape, offset) in header['sections'].items():
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + offset, shape=tuple(shape))
+    return header['info'], arrays
+
+
+def graph_from_dense(leaf_ids, adj_mat, larger, threshold=None):
+    # PartnetGraph keeping the leaf pairs at most threshold apart (every pair for None), larger[i, j] tells
+    # whether leaf i counts as the larger box of the pair
+    mask = np.ones(adj_mat.shape, dtype=bool) if threshold is None else adj_mat <= threshold
+    np.fill_diagonal(mask, False)
+    rows, cols = np.nonzero(mask)
+    indptr = np.zeros(len(leaf_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(leaf_ids)), out=indptr[1:])
+    return PartnetGraph(np.asarray(leaf_ids, dtype=np.int64), indptr, cols.astype(np.int32),
+                        adj_mat[rows, cols].astype(np.float64), larger[rows, cols])
+
+
+def pack_graph_store(path, num_items, graphs, fingerprint, bboxes=None, info=None):
+    # graphs yields (item_id, PartnetGraph); items never yielded are stored as missing.
+    # bboxes, the (num_parts, 8, 3) corners indexed by part id, are copied next to the leaves so every item
+    # gets one contiguous (num_leaves, 8, 3) block. info adds entries to the header
+    item_graphs = [None] * num_items
+    for item_id, graph in graphs:
+        item_graphs[item_id] = graph
+    present = np.array([graph is not None for graph in item_graphs], dtype=bool)
+    item_graphs = [graph if graph is not None else graph_from_dense([], np.zeros((0, 0)), np.zeros((0, 0), dtype=bool))
+                   for graph in item_graphs]
+
+    num_leaves = np.array([len(graph.leaf_ids) for graph in item_graphs], dtype=np.int64)
+    num_edges = np.array([len(graph.indices) for graph in item_graphs], dtype=np.int64)
+    item_leaf_offsets = np.zeros(num_items + 1, dtype=np.int64)
+    np.cumsum(num_leaves, out=item_leaf_offsets[1:])
+    edge_starts = np.repeat(np.cumsum(num_edges) - num_edges, num_leaves)
+    leaf_edge_offsets = np.zeros(item_leaf_offsets[-1] + 1, dtype=np.int64)
+    if len(item_graphs) > 0:
+        leaf_edge_offsets[1:] = np.concatenate([graph.indptr[1:] for graph in item_graphs]) + edge_starts
+
+    arrays = {
+        'present': present,
+        'item_leaf_offsets': item_leaf_offsets,
+        'leaf_ids': np.concatenate([graph.leaf_ids for graph in item_graphs] + [np.zeros(0, dtype=np.int64)]),
+        'leaf_edge_offsets': leaf_edge_offsets,
+        'indices': np.concatenate([graph.indices for graph in item_graphs] + [np.zeros(0, dtype=np.int32)]),
+        'distances': np.concatenate([graph.distances for graph in item_graphs] + [np.zeros(0)]),
+        'directional': np.concatenate([graph.directional for graph in item_graphs] + [np.zeros(0, dtype=bool)]),
+    }
+    if bboxes is not None:
+        arrays['leaf_corners'] = np.asarray(bboxes, dtype=np.float64)[arrays['leaf_ids']].reshape(-1, 8, 3)
+    header = dict(info or {}, fingerprint=fingerprint, num_items=num_items)
+    write_packed(path, arrays, header)
+
+
+class PartnetGraphStore():
+    # memory-maps <graph_dir>/graph_store.bin, the graph of an item is sliced out in O(leaves + edges)
+    def __init__(self, graph_dir=None, fingerprint=None):
+        if graph_dir is None:
+            graph_dir = cfg.graph_dir
+        self.path = os.path.join(graph_dir, GRAPH_STORE_NAME)
+        self.info, arrays = read_packed(self.path)
+        if fingerprint is not None:
+            assert self.info['fingerprint'] == fingerprint, "graph store was built for another meta, rebuild it"
+        self.present = arrays['present']
+        self.item_leaf_offsets = arrays['item_leaf_offsets']
+        self.leaf_ids = arrays['leaf_ids']
+        self.leaf_edge_offsets = arrays['leaf_edge_offsets']
+        self.indices = arrays['indices']
+        self.distances = arrays['distances']
+        self.directional = arrays['directional']
+        # None unless packed with bboxes
+        self.leaf_corners = arrays.get('leaf_corners')
+
+    def __len__(self):
+        return self.info['num_items']
+
+    def __contains__(self, item_id):
+        return bool(self.present[item_id])
+
+    def __getitem__(self, item_id):
+        if not self.present[item_id]:
+            raise KeyError("no graph stored for item {}".format(item_id))
+        leaf_start, leaf_end = self.item_leaf_offsets[item_id], self.item_leaf_offsets[item_id + 1]
+        edge_offsets = self.leaf_edge_offsets[leaf_start:leaf_end + 1]
+        edge_start, edge_end = edge_offsets[0], edge_offsets[-1]
+        return PartnetGraph(self.leaf_ids[leaf_start:leaf_end], edge_offsets - edge_start,
+                            self.indices[edge_start:edge_end], self.distances[edge_start:edge_end],
+                            self.directional[edge_start:edge_end])
+
+    def get_bboxes(self, item_id):
+        # (num_leaves, 8, 3) corners of the leaves of an item, in leaf order
+        if self.leaf_corners is None:
+            raise KeyError("graph store holds no boxes, pack it with bboxes")
+        if not self.present[item_id]:
+            raise KeyError("no graph stored for item {}".format(item_id))
+        return self.leaf_corners[self.item_leaf_offsets[item_id]:self.item_leaf_offsets[item_id + 1]]
+
+    def get_adjacency_csr(self, item_id, directional=True):
+        # (indptr, indices) of the touching leaves, the sparse form of get_adjacency
+        graph = self[item_id]
+        num_leaves = len(graph.leaf_ids)
+        rows = np.repeat(np.arange(num_leaves), np.diff(graph.indptr))
+        touching = graph.distances == 0
+        if directional:
+            touching &= graph.directional
+        indptr = np.zeros(num_leaves + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[touching], minlength=num_leaves), out=indptr[1:])
+        return indptr, np.asarray(graph.indices[touching])
+
+    def get_adjacency(self, item_id, directional=True):
+        # dense 0/1 matrix of the touching leaves (distance 0); directional keeps the larger -> smaller edges only
+        indptr, indices = self.get_adjacency_csr(item_id, directional=directional)
+        num_leaves = len(indptr) - 1
+        adj = np.zeros((num_leaves, num_leaves), dtype=np.int64)
+        adj[np.repeat(np.arange(num_leaves), np.diff(indptr)), indices] = 1
+        return adj
@@ -0,0 +1,172 @@
+import os
+import sys
+
+BASE_PATH = os.path.dirname(__file__)
+sys.path.append(BASE_PATH)
+from dataset_util import fork_pool, owner_method, close_pool
+from mesh_util import load_merged_mesh, MeshView
+from partnet_config import cfg
+from partnet_meta_constructor import PartnetMetaConstructor
+
+import numpy as np
+import multiprocessing as mp
+from tqdm import tqdm
+
+VERTEX_DTYPE = np.float32
+FACE_DTYPE = np.int32
+
+
+class PartnetMeshStoreConstructor():
+    # packs the cleaned meshes of every leaf of a category into one vertex buffer and one face buffer:
+    #     <store_dir>/<cat>/vertices.bin  float32 (num_vertices, 3)
+    #     <store_dir>/<cat>/faces.bin     int32 (num_faces, 3), indices local to the leaf
+    #     <store_dir>/<cat>/index.npz     part_ids, vert_offsets, face_offsets, fingerprint of the meta
+    # index.npz is written last, a category without it is incomplete. part ids shift whenever items change,
+    # so a category packed for another fingerprint is rebuilt
+    def __init__(self, meta_constructor, store_dir=None):
+        self.meta_constructor = meta_constructor
+        self.meta = self.meta_constructor.df
+        self.parts = self.meta_constructor.parts
+        self.part_index = self.meta_constructor.part_index
+        self.obj_table = self.meta_constructor.get_obj_table(self.parts.index)
+
+        if store_dir is None:
+            self.store_dir = cfg.mesh_store_dir
+        else:
+            self.store_dir = store_dir
+
+    def _load_leaf(self, part_id):
+        mesh = load_merged_mesh(self.obj_table.get_paths(part_id))
+        return np.asarray(mesh.vertices, dtype=VERTEX_DTYPE), np.asarray(mesh.faces, dtype=FACE_DTYPE)
+
+    def _construct_cat(self, cat, num_workers=0):
+        cat_dir = os.path.join(self.store_dir, cat)
+        os.makedirs(cat_dir, exist_ok=True)
+        if os.path.exists(os.path.join(cat_dir, 'index.npz')):
+            # the buffers are rewritten in place, an interrupted rebuild must not look complete
+            os.remove(os.path.join(cat_dir, 'index.npz'))
+        item_ids = np.flatnonzero((self.meta['cat'] == cat).to_numpy())
+        part_ids = self.part_index.leafs_of_items(item_ids)
+
+        vert_offsets = np.zeros(len(part_ids) + 1, dtype=np.int64)
+        face_offsets = np.zeros(len(part_ids) + 1, dtype=np.int64)
+        if num_workers > 0:
+            pool = fork_pool(self, num_workers)
+            leafs = pool.imap(owner_method('_load_leaf'), part_ids, chunksize=16)
+        else:
+            pool = None
+            leafs = map(self._load_leaf, part_ids)
+        try:
+            with open(os.path.join(cat_dir, 'vertices.bin'), 'wb') as vert_stream, \
+                    open(os.path.join(cat_dir, 'faces.bin'), 'wb') as face_stream:
+                for i, (vertices, faces) in enumerate(tqdm(leafs, total=len(part_ids), desc=cat)):
+                    vertices.tofile(vert_stream)
+                    faces.tofile(face_stream)
+                    vert_offsets[i + 1] = vert_offsets[i] + len(vertices)
+                    face_offsets[i + 1] = face_offsets[i] + len(faces)
+        finally:
+            close_pool(pool)
+
+        np.savez(os.path.join(cat_dir, 'index.tmp.npz'), part_ids=part_ids, vert_offsets=vert_offsets,
+                 face_offsets=face_offsets, fingerprint=np.array(self.meta_constructor.fingerprint))
+        os.replace(os.path.join(cat_dir, 'index.tmp.npz'), os.path.join(cat_dir, 'index.npz'))
+
+    def _cat_is_current(self, cat):
+        index_path = os.path.join(self.store_dir, cat, 'index.npz')
+        if not os.path.exists(index_path):
+            return False
+        with np.load(index_path) as index:
+            return 'fingerprint' in index.files and str(index['fingerprint']) == self.meta_constructor.fingerprint
+
+    def construct_store(self, cat=None, use_cache=True, num_workers=0):
+        if cat is None:
+            cats = sorted(self.meta['cat'].unique())
+        elif isinstance(cat, str):
+            cats = [cat]
+        else:
+            cats = list(cat)
+        for cat in cats:
+            if use_cache and self._cat_is_current(cat):
+                continue
+            print(">>> Packing Meshes of {}".format(cat))
+            self._construct_cat(cat, num_workers=num_workers)
+        print("=== Completed Packing Meshes")
+
+
+class PartnetMeshStore():
+    # memory-maps the packed stores of one or several categories, meshes are returned as zero-copy views
+    def __init__(self, cats, fingerprint=None, store_dir=None):
+        if store_dir is None:
+            store_dir = cfg.mesh_store_dir
+        if isinstance(cats, str):
+            cats = [cats]
+
+        self.vertices = []
+        self.faces = []
+        part_ids, store_ids, vert_offsets, face_offsets = [], [], [], []
+        for store_id, cat in enumerate(cats):
+            cat_dir = os.path.join(store_dir, cat)
+            with np.load(os.path.join(cat_dir, 'index.npz')) as index:
+                if fingerprint is not None:
+                    assert 'fingerprint' in index.files and str(index['fingerprint']) == fingerprint, \
+                        "mesh store of {} was packed for another meta, rebuild it".format(cat)
+                part_ids.append(index['part_ids'])
+                vert_offsets.append(index['vert_offsets'])
+                face_offsets.append(index['face_offsets'])
+            store_ids.append(np.full(len(part_ids[-1]), store_id, dtype=np.int64))
+            self.vertices.append(self._memmap(os.path.join(cat_dir, 'vertices.bin'), VERTEX_DTYPE))
+            self.faces.append(self._memmap(os.path.join(cat_dir, 'faces.bin'), FACE_DTYPE))
+
+        # row i of the index describes part self.part_ids[i], sorted for searchsorted lookups
+        part_ids = np.concatenate(part_ids)
+        order = np.argsort(part_ids)
+        self.part_ids = part_ids[order]
+        self.store_ids = np.concatenate(store_ids)[order]
+        self.vert_starts = np.concatenate([offsets[:-1] for offsets in vert_offsets])[order]
+        self.vert_ends = np.concatenate([offsets[1:] for offsets in vert_offsets])[order]
+        self.face_starts = np.concatenate([offsets[:-1] for offsets in face_offsets])[order]
+        self.face_ends = np.concatenate([offsets[1:] for offsets in face_offsets])[order]
+
+    @staticmethod
+    def _memmap(path, dtype):
+        if os.path.getsize(path) == 0:
+            return np.zeros((0, 3), dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r').reshape(-1, 3)
+
+    def _row(self, part_id):
+        row = np.searchsorted(self.part_ids, part_id)
+        if row >= len(self.part_ids) or self.part_ids[row] != part_id:
+            raise KeyError("part {} is not a packed leaf".format(part_id))
+        return row
+
+    def __contains__(self, part_id):
+        row = np.searchsorted(self.part_ids, part_id)
+        return row < len(self.part_ids) and self.part_ids[row] == part_id
+
+    def __len__(self):
+        return len(self.part_ids)
+
+    def __getitem__(self, part_id):
+        row = self._row(part_id)
+        store_id = self.store_ids[row]
+        vertices = self.vertices[store_id][self.vert_starts[row]:self.vert_ends[row]]
+        faces = self.faces[store_id][self.face_starts[row]:self.face_ends[row]]
+        return MeshView(vertices, faces)
+
+    def get_merged(self, leaf_ids):
+        # a single leaf is returned zero-copy, several leaves are merged into fresh arrays
+        if len(leaf_ids) == 1:
+            return self[leaf_ids[0]]
+        meshes = [self[leaf_id] for leaf_id in leaf_ids]
+        vert_counts = np.array([len(mesh.vertices) for mesh in meshes], dtype=np.int64)
+        face_shift = np.repeat(np.cumsum(vert_counts) - vert_counts, [len(mesh.faces) for mesh in meshes])
+        vertices = np.concatenate([mesh.vertices for mesh in meshes])
+        faces = np.concatenate([mesh.faces for mesh in meshes]) + face_shift[:, None].astype(FACE_DTYPE)
+        return MeshView(vertices, faces)
+
+
+if __name__ == '__main__':
+    m = PartnetMetaConstructor(cfg.partnet)
+    m.construct_meta()
+    c = PartnetMeshStoreConstructor(m)
+    c.construct_store(num_workers=mp.cpu_count())
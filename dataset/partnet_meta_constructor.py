@@ -1,9 +1,11 @@
 import os
 import sys
 import json
+import hashlib
 import multiprocessing as mp
 from itertools import zip_longest, count, repeat
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from copy import deepcopy
@@ -11,20 +13,91 @@ from itertools import permutations
 
 BASE_PATH = os.path.dirname(__file__)
 sys.path.append(BASE_PATH)
+from dataset_util import fork_pool, owner_method, close_pool
 from partnet_config import cfg
+from partnet_part_index import PartnetPartIndex, gather_ranges
+
+TABLE_COLUMNS = {
+    'df': cfg.columns,
+    'parts': cfg.parts_columns,
+    'part_parent_child': cfg.part_parent_child_columns,
+    'part_sibling': cfg.part_sibling_columns,
+    'part_leaf': cfg.part_leaf_columns,
+    'mtime': cfg.mtime_columns,
+}
+# the arrays that identify the parsed meta for the derived stores (bbox, graph, mesh and pc stores): the items,
+# their parts and leaves and the obj files behind them. names, texts and mtimes are left out
+CONTENT_KEYS = ['df/cat', 'df/model_path', 'parts/global_id', 'parts/objs_dir', 'parts/objs', 'parts/objs_offsets',
+                'part_leaf/leaf_global_id']
 
 
 def grouper(iterable, n, padvalue=None):
     return zip_longest(*[iter(iterable)] * n, fillvalue=padvalue)
 
 
+def _empty_rows():
+    return {'df': [], 'parts': [], 'part_parent_child': [], 'part_sibling': [], 'part_leaf': []}
+
+
+def _relabel(global_id, item_id):
+    return str(item_id) + '_' + global_id.split('_', 1)[1]
+
+
+def _flatten_objs(parts):
+    lengths = [len(objs) for objs in parts['objs']]
+    objs = np.array([obj for objs in parts['objs'] for obj in objs], dtype=str)
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    return objs, offsets
+
+
+def _to_array(column):
+    values = column.to_numpy()
+    if values.dtype.kind in 'biuf':
+        return values
+    return values.astype(str)
+
+
+def _to_frame(data, columns):
+    # string columns are kept as object dtype, inferring a string dtype on every load costs more than the read
+    frame = {}
+    for column in columns:
+        values = np.asarray(data[column])
+        if values.dtype.kind in 'OU':
+            frame[column] = pd.Series(values.astype(object), dtype=object)
+        else:
+            frame[column] = values
+    return pd.DataFrame(frame, columns=columns)
+
+
+def _content_fingerprint(arrays):
+    digest = hashlib.sha1()
+    for key in CONTENT_KEYS:
+        value = np.ascontiguousarray(arrays[key])
+        digest.update("{}\0{}\0{}\0".format(key, value.dtype, len(value)).encode())
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+
+class PartnetObjTable():
+    # obj files of a set of parts: entry i has the objs names[offsets[i]:offsets[i + 1]] in objs_dirs[i].
+    # the paths are only joined when an entry is loaded
+    def __init__(self, objs_dirs, offsets, names):
+        self.objs_dirs = objs_dirs
+        self.offsets = offsets
+        self.names = names
+
+    def __len__(self):
+        return len(self.objs_dirs)
+
+    def get_paths(self, index):
+        objs_dir = self.objs_dirs[index]
+        names = self.names[self.offsets[index]:self.offsets[index + 1]]
+        return [os.path.join(objs_dir, name + '.obj') for name in names]
+
+
 class PartnetMetaConstructor():
     def __init__(self, path=None):
-        self.cache_file = os.path.join(BASE_PATH, 'cache.csv')
-        self.cache_parts = os.path.join(BASE_PATH, 'cache_parts.csv')
-        self.cache_part_parent_child = os.path.join(BASE_PATH, 'cache_part_parent_child.csv')
-        self.cache_part_sibling = os.path.join(BASE_PATH, 'cache_part_sibling.csv')
-        self.cache_part_leaf = os.path.join(BASE_PATH, 'cache_part_leaf.csv')
+        self.cache_file = os.path.join(BASE_PATH, 'cache.npz')
         if path is None:
             self.path = cfg.partnet
         else:
@@ -34,6 +107,11 @@ class PartnetMetaConstructor():
         self.part_parent_child = None
         self.part_sibling = None
         self.part_leaf = None
+        self.part_index = None
+        self.part_objs = None
+        self.part_obj_offsets = None
+        # identity of the parsed meta, derived stores record it and check it on open
+        self.fingerprint = None
 
     @staticmethod
     def _postfix(tree):
@@ -54,7 +132,7 @@ class PartnetMetaConstructor():
             tree['height'] = 1
         return res, tree['height']
 
-    def _hier(self, tree, item_id, dirname):
+    def _hier(self, tree, item_id, dirname, rows):
         queue = [(0, tree)]
         visited = set()
         while len(queue) > 0:
@@ -63,8 +141,8 @@ class PartnetMetaConstructor():
                 visited.add(repr(node))
                 # print('  ' * depth, depth, node['height'], node['objs'])
                 global_id = str(item_id) + '_' + str(node['id'])
-                objs_path = os.path.join(self.path, dirname, 'objs')
-                self.parts.append({
+                objs_path = os.path.join(dirname, 'objs')
+                rows['parts'].append({
                     'global_id': global_id,
                     'item_id': item_id,
                     'part_relative_id': node['id'],
@@ -79,22 +157,22 @@ class PartnetMetaConstructor():
                 if 'children' in node:
                     for child in node['children']:
                         queue.append((depth + 1, child))
-                        self.part_parent_child.append({
+                        rows['part_parent_child'].append({
                             'parent_global_id': global_id,
                             'child_global_id': str(item_id) + '_' + str(child['id'])
                         })
                     if len(node['children']) > 1:
                         for fst, snd in permutations(node['children'], 2):
-                            self.part_sibling.append({
+                            rows['part_sibling'].append({
                                 'sibling_a_id': str(item_id) + '_' + str(fst['id']),
                                 'sibling_b_id': str(item_id) + '_' + str(snd['id'])
                             })
                 else:
-                    self.part_leaf.append({
+                    rows['part_leaf'].append({
                         'leaf_global_id': global_id
                     })
 
-    def _parse_part_tree(self, item_id, dirname):
+    def _parse_part_tree(self, item_id, dirname, rows):
         # print(item_id, dirname)
         item_path = os.path.join(self.path, dirname)
         result_path = os.path.join(item_path, 'result.json')
@@ -103,66 +181,243 @@ class PartnetMetaConstructor():
             assert len(tree_raw) == 1
             tree = deepcopy(tree_raw[0])
         self._postfix(tree)
-        self._hier(tree, item_id, dirname)
+        self._hier(tree, item_id, dirname, rows)
 
     def _parse_meta(self, item_id, dirname):
+        # returns the rows of a single item, so that it can run in a worker process
+        rows = _empty_rows()
         item_path = os.path.join(self.path, dirname)
         meta_path = os.path.join(item_path, "meta.json")
-        pointcloud_path = os.path.join(item_path, 'point_sample', 'sample-points-all-pts-nor-rgba-10000.ply')
+        # paths are kept relative to the dataset root until the tables are loaded, see _resolve_paths
+        pointcloud_path = os.path.join(dirname, 'point_sample', 'sample-points-all-pts-nor-rgba-10000.ply')
         with open(meta_path, "r") as stream:
             desc = json.load(stream)
-            self.df.append({'anno_id': desc['anno_id'],
-                            'model_id': desc['model_id'],
-                            'cat': desc['model_cat'],
-                            'model_path': pointcloud_path})
-        self._parse_part_tree(item_id, dirname)
-        return True
-
-    def _construct_meta(self):
-        counter = 0
-        for i, dirname in enumerate(tqdm(os.listdir(self.path))):
-            ret = self._parse_meta(i, dirname)
-            if ret:
-                counter += 1
-
-    def construct_meta(self, use_cache=True):
-        print(">>> Start Constructing Meta")
-        if use_cache and os.path.exists(self.cache_file):
-            print(">>> Using Cached Meta")
-            self.df = pd.read_csv(self.cache_file, usecols=cfg.columns)
-            self.parts = pd.read_csv(self.cache_parts, usecols=cfg.parts_columns)
-            self.part_parent_child = pd.read_csv(self.cache_part_parent_child, usecols=cfg.part_parent_child_columns)
-            self.part_sibling = pd.read_csv(self.cache_part_sibling, usecols=cfg.part_sibling_columns)
-            self.part_leaf = pd.read_csv(self.cache_part_leaf, usecols=cfg.part_leaf_columns)
+            rows['df'].append({'anno_id': desc['anno_id'],
+                               'model_id': desc['model_id'],
+                               'cat': desc['model_cat'],
+                               'model_path': pointcloud_path})
+        self._parse_part_tree(item_id, dirname, rows)
+        return rows
+
+    def _parse_meta_task(self, task):
+        return self._parse_meta(*task)
+
+    def _item_mtime(self, dirname):
+        item_path = os.path.join(self.path, dirname)
+        return (os.stat(os.path.join(item_path, 'meta.json')).st_mtime_ns,
+                os.stat(os.path.join(item_path, 'result.json')).st_mtime_ns)
+
+    def _item_dirnames(self):
+        # item directories of the root in sorted order, stray files such as a README are skipped
+        with os.scandir(self.path) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+
+    def _root_key(self):
+        # cheap check of the cache against the root: the names of its item directories. edits inside an item
+        # are only looked for with incremental=True, see _items_changed
+        if not os.path.isdir(self.path):
+            return None
+        return hashlib.sha1('\0'.join(self._item_dirnames()).encode()).hexdigest()
+
+    def _items_changed(self, mtime):
+        # stats meta.json / result.json of every item against the mtimes recorded in the cache
+        recorded = zip(mtime['meta_mtime'].tolist(), mtime['result_mtime'].tolist())
+        return any(self._item_mtime(dirname) != old for dirname, old in zip(mtime['dirname'].tolist(), recorded))
+
+    def _save_cache(self, tables, root_key):
+        # the fingerprint is computed from the parsed content, so it does not depend on where the root lives
+        arrays = {'version': np.array(cfg.meta_cache_version),
+                  'root_key': np.array('' if root_key is None else root_key)}
+        for name, columns in TABLE_COLUMNS.items():
+            frame = tables[name]
+            for column in columns:
+                if name == 'parts' and column == 'objs':
+                    # list-typed column, stored flat with offsets
+                    arrays['parts/objs'], arrays['parts/objs_offsets'] = tables['objs']
+                else:
+                    arrays[name + '/' + column] = _to_array(frame[column])
+        for key, value in tables['index'].to_arrays().items():
+            arrays['index/' + key] = value
+        arrays['fingerprint'] = np.array(_content_fingerprint(arrays))
+        tmp_file = self.cache_file + '.tmp.npz'
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, self.cache_file)
+        return str(arrays['fingerprint'])
+
+    def _load_cache(self, root_key=None):
+        # returns None when the cache was written by another schema version or for another set of item directories.
+        # obj names stay flat, the parts table has no objs column
+        with np.load(self.cache_file, allow_pickle=False) as cache:
+            if 'version' not in cache.files or int(cache['version']) != cfg.meta_cache_version:
+                return None
+            if root_key is not None and str(cache['root_key']) != root_key:
+                return None
+            tables = {}
+            for name, columns in TABLE_COLUMNS.items():
+                columns = [column for column in columns if not (name == 'parts' and column == 'objs')]
+                tables[name] = _to_frame({column: cache[name + '/' + column] for column in columns}, columns)
+            tables['index'] = PartnetPartIndex({key: cache['index/' + key] for key in PartnetPartIndex.keys},
+                                               tables['parts']['global_id'])
+            tables['objs'] = (cache['parts/objs'], cache['parts/objs_offsets'])
+            tables['fingerprint'] = str(cache['fingerprint'])
+        return tables
+
+    def _resolve_paths(self, tables):
+        # the cache holds paths relative to the root, so a moved or copied root reuses it with its own paths
+        prefix = os.path.join(self.path, '')
+        tables['df']['model_path'] = prefix + tables['df']['model_path']
+        tables['parts']['objs_dir'] = prefix + tables['parts']['objs_dir']
+        return tables
+
+    def _load_cached_rows(self):
+        # split the previous cache into per-item row batches, keyed by dirname
+        tables = self._load_cache() if os.path.exists(self.cache_file) else None
+        if tables is None:
+            return {}, {}
+        df = tables['df']
+        objs, offsets = tables['objs'][0].tolist(), tables['objs'][1].tolist()
+        tables['parts']['objs'] = [objs[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        owners = {
+            'df': pd.Series(df.index, index=df.index),
+            'parts': tables['parts']['item_id'],
+            'part_parent_child': tables['part_parent_child']['parent_global_id'],
+            'part_sibling': tables['part_sibling']['sibling_a_id'],
+            'part_leaf': tables['part_leaf']['leaf_global_id'],
+        }
+        cached = {}
+        for key, owner in owners.items():
+            table = tables[key]
+            if not pd.api.types.is_integer_dtype(owner):
+                owner = owner.str.split('_', n=1).str[0].astype(int)
+            for item_id, group in table.groupby(owner.values):
+                cached.setdefault(item_id, _empty_rows())[key] = group.to_dict('records')
+
+        cached_rows, cached_mtime = {}, {}
+        for row in tables['mtime'].itertuples():
+            cached_rows[row.dirname] = (row.item_id, cached.get(row.item_id, _empty_rows()))
+            cached_mtime[row.dirname] = (row.meta_mtime, row.result_mtime)
+        return cached_rows, cached_mtime
+
+    @staticmethod
+    def _relabel_rows(rows, item_id):
+        for row in rows['parts']:
+            row['item_id'] = item_id
+            row['global_id'] = _relabel(row['global_id'], item_id)
+        for row in rows['part_parent_child']:
+            row['parent_global_id'] = _relabel(row['parent_global_id'], item_id)
+            row['child_global_id'] = _relabel(row['child_global_id'], item_id)
+        for row in rows['part_sibling']:
+            row['sibling_a_id'] = _relabel(row['sibling_a_id'], item_id)
+            row['sibling_b_id'] = _relabel(row['sibling_b_id'], item_id)
+        for row in rows['part_leaf']:
+            row['leaf_global_id'] = _relabel(row['leaf_global_id'], item_id)
+        return rows
+
+    def _construct_meta(self, num_workers=0, incremental=False):
+        # item ids follow the sorted directory order, so every build mode yields the same ids
+        dirnames = self._item_dirnames()
+        mtimes = [self._item_mtime(dirname) for dirname in dirnames]
+
+        cached_rows, cached_mtime = self._load_cached_rows() if incremental else ({}, {})
+        results = [None] * len(dirnames)
+        tasks = []
+        for i, dirname in enumerate(dirnames):
+            if cached_mtime.get(dirname) == mtimes[i]:
+                old_item_id, rows = cached_rows[dirname]
+                results[i] = rows if old_item_id == i else self._relabel_rows(rows, i)
+            else:
+                tasks.append((i, dirname))
+        if incremental:
+            print(">>> Reusing {} Cached Items, Parsing {} Items".format(len(dirnames) - len(tasks), len(tasks)))
+
+        if num_workers > 0 and len(tasks) > 0:
+            pool = fork_pool(self, num_workers)
+            try:
+                parsed = pool.imap(owner_method('_parse_meta_task'), tasks,
+                                   chunksize=max(1, len(tasks) // (num_workers * 16)))
+                for (i, _), rows in zip(tasks, tqdm(parsed, total=len(tasks))):
+                    results[i] = rows
+            finally:
+                close_pool(pool)
         else:
-            self.df = []
-            self.parts = []
-            self.part_parent_child = []
-            self.part_sibling = []
-            self.part_leaf = []
+            for i, dirname in tqdm(tasks):
+                results[i] = self._parse_meta(i, dirname)
 
-            self._construct_meta()
-            print(">>> Creating Pandas DataFrames")
+        merged = _empty_rows()
+        for rows in results:
+            for key in merged:
+                merged[key].extend(rows[key])
+        mtime = pd.DataFrame({'dirname': dirnames,
+                              'item_id': range(len(dirnames)),
+                              'meta_mtime': [m[0] for m in mtimes],
+                              'result_mtime': [m[1] for m in mtimes]})
+        return merged, mtime
 
-            self.df = pd.DataFrame(self.df, columns=cfg.columns)
-            self.parts = pd.DataFrame(self.parts, columns=cfg.parts_columns)
-            self.part_parent_child = pd.DataFrame(self.part_parent_child, columns=cfg.part_parent_child_columns)
-            self.part_sibling = pd.DataFrame(self.part_sibling, columns=cfg.part_sibling_columns)
-            self.part_leaf = pd.DataFrame(self.part_leaf, columns=cfg.part_leaf_columns)
+    def construct_meta(self, use_cache=True, num_workers=0, incremental=False):
+        # the cache is used as long as the root holds the same item directories (or is not there at all).
+        # incremental=True also compares the mtimes of every item and re-parses only the edited ones
+        print(">>> Start Constructing Meta")
+        root_key = self._root_key()
+        tables = None
+        if use_cache and os.path.exists(self.cache_file):
+            tables = self._load_cache(root_key)
+            if tables is not None and incremental and root_key is not None and self._items_changed(tables['mtime']):
+                tables = None
+            if tables is None:
+                # stale cache, only re-parse what changed
+                print(">>> Cached Meta Is Stale, Rebuilding")
+                incremental = True
+            else:
+                print(">>> Using Cached Meta")
+        if tables is None:
+            rows, mtime = self._construct_meta(num_workers=num_workers, incremental=incremental)
+            print(">>> Creating Pandas DataFrames")
+            tables = {name: pd.DataFrame(rows[name], columns=columns)
+                      for name, columns in TABLE_COLUMNS.items() if name != 'mtime'}
+            tables['mtime'] = mtime
+            tables['index'] = PartnetPartIndex.from_frames(tables['df'], tables['parts'], tables['part_parent_child'],
+                                                           tables['part_sibling'], tables['part_leaf'])
+            tables['objs'] = _flatten_objs(tables['parts'])
 
             print(">>> Caching Pandas DataFrames")
-            self.df.to_csv(self.cache_file)
-            self.parts.to_csv(self.cache_parts)
-            self.part_parent_child.to_csv(self.cache_part_parent_child)
-            self.part_sibling.to_csv(self.cache_part_sibling)
-            self.part_leaf.to_csv(self.cache_part_leaf)
+            tables['fingerprint'] = self._save_cache(tables, root_key)
+            # same layout as a cached load
+            for name, columns in TABLE_COLUMNS.items():
+                columns = [column for column in columns if not (name == 'parts' and column == 'objs')]
+                tables[name] = _to_frame({column: tables[name][column].to_numpy() for column in columns}, columns)
+            tables['index'].global_ids = tables['parts']['global_id']
+
+        self._resolve_paths(tables)
+        self.df = tables['df']
+        self.parts = tables['parts']
+        self.part_parent_child = tables['part_parent_child']
+        self.part_sibling = tables['part_sibling']
+        self.part_leaf = tables['part_leaf']
+        self.part_index = tables['index']
+        self.part_objs, self.part_obj_offsets = tables['objs']
+        self.fingerprint = tables['fingerprint']
         print("=== Completed Constructed Meta")
 
+    def get_objs(self, part_id):
+        # obj names of one part
+        return self.part_objs[self.part_obj_offsets[part_id]:self.part_obj_offsets[part_id + 1]].tolist()
+
+    def get_obj_table(self, part_ids):
+        # obj files of the given parts, entry i of the table belongs to part_ids[i]
+        part_ids = np.asarray(part_ids, dtype=np.int64)
+        objs_dirs = self.parts['objs_dir'].to_numpy()[part_ids]
+        if np.array_equal(part_ids, np.arange(len(self.parts))):
+            # every part, share the flat arrays of the meta
+            return PartnetObjTable(objs_dirs, self.part_obj_offsets, self.part_objs)
+        lengths = self.part_obj_offsets[part_ids + 1] - self.part_obj_offsets[part_ids]
+        offsets = np.zeros(len(part_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return PartnetObjTable(objs_dirs, offsets, gather_ranges(self.part_obj_offsets, part_ids, self.part_objs))
 
 if __name__ == '__main__':
     print(pd.__version__)
     from partnet_config import cfg
 
     m = PartnetMetaConstructor(cfg.partnet)
-    m.construct_meta(use_cache=False)
+    m.construct_meta(use_cache=False, num_workers=mp.cpu_count())
     print(m.df.loc[:, 'cat'].unique())
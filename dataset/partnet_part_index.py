@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+
+def gather_ranges(offsets, ids, values=None):
+    # concatenates values[offsets[i]:offsets[i + 1]] for every i in ids without a python loop
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    starts = offsets[ids]
+    lengths = offsets[ids + 1] - starts
+    heads = np.cumsum(lengths) - lengths
+    res = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - heads, lengths)
+    if values is None:
+        return res
+    return values[res]
+
+
+def _csr(keys, values, size):
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=size), out=offsets[1:])
+    return offsets, values[order].astype(np.int64)
+
+
+class PartnetPartIndex():
+    # part id == row of the parts table; parts of an item are contiguous
+    keys = ['item_part_offsets', 'item_leaf_offsets', 'leaf_ids', 'parent_ids',
+            'child_offsets', 'child_ids', 'sibling_offsets', 'sibling_ids']
+
+    def __init__(self, arrays, global_ids=None):
+        for key in self.keys:
+            setattr(self, key, np.asarray(arrays[key]))
+        self.num_items = len(self.item_part_offsets) - 1
+        self.num_parts = len(self.parent_ids)
+        self.global_ids = global_ids
+        self._global_id_index = None
+        self._subtree_leaf_offsets = None
+        self._subtree_leaf_ids = None
+
+    @classmethod
+    def from_frames(cls, df, parts, part_parent_child, part_sibling, part_leaf):
+        num_items = len(df)
+        num_parts = len(parts)
+        item_ids = parts['item_id'].to_numpy().astype(np.int64)
+        assert np.all(np.diff(item_ids) >= 0), "parts must be grouped by item"
+        global_id_index = pd.Index(parts['global_id'])
+
+        item_part_offsets = np.zeros(num_items + 1, dtype=np.int64)
+        np.cumsum(np.bincount(item_ids, minlength=num_items), out=item_part_offsets[1:])
+
+        leaf_ids = np.sort(global_id_index.get_indexer(part_leaf['leaf_global_id']))
+        item_leaf_offsets = np.zeros(num_items + 1, dtype=np.int64)
+        np.cumsum(np.bincount(item_ids[leaf_ids], minlength=num_items), out=item_leaf_offsets[1:])
+
+        parent = global_id_index.get_indexer(part_parent_child['parent_global_id'])
+        child = global_id_index.get_indexer(part_parent_child['child_global_id'])
+        parent_ids = np.full(num_parts, -1, dtype=np.int64)
+        parent_ids[child] = parent
+        child_offsets, child_ids = _csr(parent, child, num_parts)
+
+        sibling_a = global_id_index.get_indexer(part_sibling['sibling_a_id'])
+        sibling_b = global_id_index.get_indexer(part_sibling['sibling_b_id'])
+        sibling_offsets, sibling_ids = _csr(sibling_a, sibling_b, num_parts)
+
+        res = cls({
+            'item_part_offsets': item_part_offsets,
+            'item_leaf_offsets': item_leaf_offsets,
+            'leaf_ids': leaf_ids.astype(np.int64),
+            'parent_ids': parent_ids,
+            'child_offsets': child_offsets,
+            'child_ids': child_ids,
+            'sibling_offsets': sibling_offsets,
+            'sibling_ids': sibling_ids,
+        }, parts['global_id'])
+        res._global_id_index = global_id_index
+        return res
+
+    def to_arrays(self):
+        return {key: getattr(self, key) for key in self.keys}
+
+    def parts_of_items(self, item_ids):
+        return gather_ranges(self.item_part_offsets, item_ids)
+
+    def leafs_of_items(self, item_ids):
+        return gather_ranges(self.item_leaf_offsets, item_ids, self.leaf_ids)
+
+    def _build_subtree_leafs(self):
+        # walk every leaf up to its root, collecting (ancestor, leaf) pairs level by level
+        ancestors, leafs = self.leaf_ids, self.leaf_ids
+        ancestor_list, leaf_list = [], []
+        while len(ancestors) > 0:
+            ancestor_list.append(ancestors)
+            leaf_list.append(leafs)
+            parents = self.parent_ids[ancestors]
+            ancestors, leafs = parents[parents >= 0], leafs[parents >= 0]
+        ancestors = np.concatenate(ancestor_list)
+        leafs = np.concatenate(leaf_list)
+        order = np.lexsort((leafs, ancestors))
+        self._subtree_leaf_offsets = np.zeros(self.num_parts + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ancestors, minlength=self.num_parts), out=self._subtree_leaf_offsets[1:])
+        self._subtree_leaf_ids = leafs[order]
+
+    def leafs_of_parts(self, part_ids):
+        # leaves below each part (a leaf maps to itself): leaf_ids[offsets[i]:offsets[i + 1]] belong to part_ids[i]
+        if self._subtree_leaf_offsets is None:
+            self._build_subtree_leafs()
+        part_ids = np.asarray(part_ids, dtype=np.int64)
+        lengths = self._subtree_leaf_offsets[part_ids + 1] - self._subtree_leaf_offsets[part_ids]
+        offsets = np.zeros(len(part_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return offsets, gather_ranges(self._subtree_leaf_offsets, part_ids, self._subtree_leaf_ids)
+
+    def children(self, part_id):
+        return self.child_ids[self.child_offsets[part_id]:self.child_offsets[part_id + 1]]
+
+    def siblings(self, part_id):
+        return self.sibling_ids[self.sibling_offsets[part_id]:self.sibling_offsets[part_id + 1]]
+
+    def parent(self, part_id):
+        return self.parent_ids[part_id]
+
+    def part_ids(self, global_ids):
+        if self._global_id_index is None:
+            self._global_id_index = pd.Index(self.global_ids)
+        res = self._global_id_index.get_indexer(global_ids)
+        assert np.all(res >= 0), "unknown global id"
+        return res
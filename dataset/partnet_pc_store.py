@@ -0,0 +1,141 @@
+import os
+import sys
+
+BASE_PATH = os.path.dirname(__file__)
+sys.path.append(BASE_PATH)
+from dataset_util import fork_pool, owner_method, close_pool
+from mesh_util import load_pc, MeshView
+from partnet_config import cfg
+from partnet_meta_constructor import PartnetMetaConstructor
+
+import numpy as np
+import multiprocessing as mp
+from tqdm import tqdm
+
+NORMAL_ATTRIBUTES = ['vertex_nx', 'vertex_ny', 'vertex_nz']
+RGBA_ATTRIBUTES = ['vertex_red', 'vertex_green', 'vertex_blue', 'vertex_alpha']
+
+def _get_attributes(mesh, names, dtype):
+    res = np.zeros((len(mesh.vertices), len(names)), dtype=dtype)
+    for i, name in enumerate(names):
+        if mesh.has_attribute(name):
+            res[:, i] = mesh.get_attribute(name)
+    return res
+
+
+class PartnetPointCloudStoreConstructor():
+    # packs the sampled point cloud of every instance into typed arrays indexed by item id:
+    #     <store_dir>/positions.npy  float32 (num_items, num_points, 3)
+    #     <store_dir>/normals.npy    float32 (num_items, num_points, 3)
+    #     <store_dir>/rgba.npy       uint8 (num_items, num_points, 4)
+    #     <store_dir>/index.npz      counts int32 (num_items,), number of valid points, the rest is zero padded;
+    #                                fingerprint of the meta
+    # index.npz is written last, a store without it is incomplete. item ids shift whenever items change,
+    # so a store packed for another fingerprint is rebuilt
+    def __init__(self, meta_constructor, store_dir=None, num_points=None):
+        self.meta_constructor = meta_constructor
+        self.meta = self.meta_constructor.df
+        self.model_paths = self.meta['model_path'].to_numpy()
+
+        if store_dir is None:
+            self.store_dir = cfg.pc_store_dir
+        else:
+            self.store_dir = store_dir
+        if num_points is None:
+            self.num_points = cfg.pc_store_points
+        else:
+            self.num_points = num_points
+
+    def _load_item(self, item_id):
+        mesh = load_pc(self.model_paths[item_id])
+        positions = np.asarray(mesh.vertices, dtype=np.float32)
+        normals = _get_attributes(mesh, NORMAL_ATTRIBUTES, np.float32)
+        rgba = _get_attributes(mesh, RGBA_ATTRIBUTES, np.uint8)
+        return positions[:self.num_points], normals[:self.num_points], rgba[:self.num_points]
+
+    def _is_current(self):
+        index_path = os.path.join(self.store_dir, 'index.npz')
+        if not os.path.exists(index_path):
+            return False
+        with np.load(index_path) as index:
+            return str(index['fingerprint']) == self.meta_constructor.fingerprint
+
+    def construct_store(self, use_cache=True, num_workers=0):
+        if use_cache and self._is_current():
+            return None
+
+        print(">>> Packing Instance Point Clouds")
+        os.makedirs(self.store_dir, exist_ok=True)
+        if os.path.exists(os.path.join(self.store_dir, 'index.npz')):
+            # the arrays are rewritten in place, an interrupted rebuild must not look complete
+            os.remove(os.path.join(self.store_dir, 'index.npz'))
+        num_items = len(self.meta)
+        shape = (num_items, self.num_points)
+        positions = np.lib.format.open_memmap(os.path.join(self.store_dir, 'positions.npy'), mode='w+',
+                                              dtype=np.float32, shape=shape + (3,))
+        normals = np.lib.format.open_memmap(os.path.join(self.store_dir, 'normals.npy'), mode='w+',
+                                            dtype=np.float32, shape=shape + (3,))
+        rgba = np.lib.format.open_memmap(os.path.join(self.store_dir, 'rgba.npy'), mode='w+',
+                                         dtype=np.uint8, shape=shape + (4,))
+        counts = np.zeros(num_items, dtype=np.int32)
+
+        if num_workers > 0:
+            pool = fork_pool(self, num_workers)
+            items = pool.imap(owner_method('_load_item'), range(num_items), chunksize=16)
+        else:
+            pool = None
+            items = map(self._load_item, range(num_items))
+        try:
+            for item_id, (item_positions, item_normals, item_rgba) in enumerate(tqdm(items, total=num_items)):
+                count = len(item_positions)
+                positions[item_id, :count] = item_positions
+                normals[item_id, :count] = item_normals
+                rgba[item_id, :count] = item_rgba
+                counts[item_id] = count
+        finally:
+            close_pool(pool)
+
+        positions.flush()
+        normals.flush()
+        rgba.flush()
+        np.savez(os.path.join(self.store_dir, 'index.tmp.npz'), counts=counts,
+                 fingerprint=np.array(self.meta_constructor.fingerprint))
+        os.replace(os.path.join(self.store_dir, 'index.tmp.npz'), os.path.join(self.store_dir, 'index.npz'))
+        print("=== Completed Packing Instance Point Clouds")
+
+
+class PartnetPointCloudStore():
+    # read-only memory maps, pages are shared between every process reading the store
+    def __init__(self, fingerprint=None, store_dir=None):
+        if store_dir is None:
+            store_dir = cfg.pc_store_dir
+        with np.load(os.path.join(store_dir, 'index.npz')) as index:
+            if fingerprint is not None:
+                assert str(index['fingerprint']) == fingerprint, \
+                    "point cloud store was packed for another meta, rebuild it"
+            self.counts = index['counts']
+        self.positions = np.load(os.path.join(store_dir, 'positions.npy'), mmap_mode='r')
+        self.normals = np.load(os.path.join(store_dir, 'normals.npy'), mmap_mode='r')
+        self.rgba = np.load(os.path.join(store_dir, 'rgba.npy'), mmap_mode='r')
+
+    def get_positions(self, item_id):
+        return self.positions[item_id, :self.counts[item_id]]
+
+    def get_normals(self, item_id):
+        return self.normals[item_id, :self.counts[item_id]]
+
+    def get_rgba(self, item_id):
+        return self.rgba[item_id, :self.counts[item_id]]
+
+    def __getitem__(self, item_id):
+        return MeshView(self.get_positions(item_id), np.zeros((0, 3), dtype=np.int32))
+
+    def __len__(self):
+        return len(self.counts)
+
+
+if __name__ == '__main__':
+    m = PartnetMetaConstructor(cfg.partnet)
+    m.construct_meta()
+    c = PartnetPointCloudStoreConstructor(m)
+    c.construct_store(num_workers=mp.cpu_count())
@@ -24,3 +24,115 @@ def sample_choice_points_factory(num_points):
         return x[mask, :]
 
     return _sample_points
+
+
+# batch-level operators: they take the whole list of samples of a batch and return one batch array.
+# they draw from a per-process generator, which the loader reseeds in every worker.
+_rng = np.random.default_rng()
+
+
+def seed_rng(seed=None):
+    global _rng
+    _rng = np.random.default_rng(seed)
+
+
+def get_rng():
+    return _rng
+
+
+def batched(func):
+    func.batched = True
+    return func
+
+
+def _ragged(batch):
+    # flat points + per-sample lengths/offsets of a (B, N, C) array or a list of (N_i, C) arrays
+    if isinstance(batch, np.ndarray):
+        lengths = np.full(batch.shape[0], batch.shape[1], dtype=np.int64)
+        flat = batch.reshape(-1, batch.shape[-1])
+    else:
+        lengths = np.array([len(x) for x in batch], dtype=np.int64)
+        flat = np.concatenate(batch)
+    offsets = np.cumsum(lengths) - lengths
+    return flat, lengths, offsets
+
+
+def batch_sample_points_factory(num_points):
+    # without replacement: the num_points smallest of one random key per point
+    @batched
+    def _sample_points(batch):
+        flat, lengths, offsets = _ragged(batch)
+        assert lengths.min() >= num_points, "sample has fewer than {} points".format(num_points)
+        keys = _rng.random((len(lengths), lengths.max()))
+        keys[np.arange(lengths.max()) >= lengths[:, None]] = np.inf
+        if num_points < lengths.max():
+            mask = np.argpartition(keys, num_points - 1, axis=1)[:, :num_points]
+        else:
+            mask = np.argsort(keys, axis=1)
+        return flat[offsets[:, None] + mask]
+
+    return _sample_points
+
+
+def batch_sample_choice_points_factory(num_points):
+    # with replacement: a single integer draw for the whole batch
+    @batched
+    def _sample_points(batch):
+        flat, lengths, offsets = _ragged(batch)
+        mask = _rng.integers(0, lengths[:, None], size=(len(lengths), num_points))
+        return flat[offsets[:, None] + mask]
+
+    return _sample_points
+
+
+def farthest_point_sample_factory(num_points):
+    # iterative farthest point sampling on the xyz channels, vectorized over the batch
+    @batched
+    def _sample_points(batch):
+        flat, lengths, offsets = _ragged(batch)
+        batch_size, max_len = len(lengths), lengths.max()
+        padded = np.arange(max_len) >= lengths[:, None]
+        index = np.minimum(offsets[:, None] + np.arange(max_len), len(flat) - 1)
+        xyz = flat[index][:, :, :3].astype(np.float64)
+
+        res = np.empty((batch_size, num_points), dtype=np.int64)
+        dist = np.full((batch_size, max_len), np.inf)
+        dist[padded] = -1.0
+        current = _rng.integers(0, lengths)
+        rows = np.arange(batch_size)
+        for i in range(num_points):
+            res[:, i] = current
+            d = np.sum((xyz - xyz[rows, current][:, None, :]) ** 2, axis=-1)
+            dist = np.minimum(dist, d)
+            current = np.argmax(dist, axis=1)
+        return flat[offsets[:, None] + res]
+
+    return _sample_points
+
+
+def surface_sample_factory(num_points):
+    # area-weighted uniform sampling on the triangles of meshes (anything with vertices and faces)
+    @batched
+    def _sample_points(batch):
+        triangles = [np.asarray(mesh.vertices, dtype=np.float64)[np.asarray(mesh.faces)] for mesh in batch]
+        face_counts = np.array([len(t) for t in triangles], dtype=np.int64)
+        assert face_counts.min() > 0, "cannot sample the surface of a mesh without faces"
+        triangles = np.concatenate(triangles)
+        areas = 0.5 * np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0],
+                                              triangles[:, 2] - triangles[:, 0]), axis=1)
+        cum_areas = np.cumsum(areas)
+        face_ends = np.cumsum(face_counts)
+        face_starts = face_ends - face_counts
+        area_starts = np.concatenate(([0.0], cum_areas))[face_starts]
+        area_totals = cum_areas[face_ends - 1] - area_starts
+
+        u = area_starts[:, None] + _rng.random((len(batch), num_points)) * area_totals[:, None]
+        faces = np.searchsorted(cum_areas, u, side='right')
+        faces = np.clip(faces, face_starts[:, None], face_ends[:, None] - 1)
+
+        r1 = np.sqrt(_rng.random((len(batch), num_points, 1)))
+        r2 = _rng.random((len(batch), num_points, 1))
+        tri = triangles[faces]
+        return (1 - r1) * tri[:, :, 0] + r1 * (1 - r2) * tri[:, :, 1] + r1 * r2 * tri[:, :, 2]
+
+    return _sample_points
@@ -0,0 +1,107 @@
+import numpy as np
+
+
+class Sampler(object):
+    # yields the dataset indices of one epoch, set_epoch is called by the loader before every epoch
+    def __init__(self, dataset, seed=None):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _get_rng(self):
+        # with a seed every epoch is reproducible, otherwise draw from the global numpy state
+        if self.seed is None:
+            return np.random
+        return np.random.RandomState((self.seed + self.epoch) % 2 ** 32)
+
+    def get_indices(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        return iter(self.get_indices())
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class SequentialSampler(Sampler):
+    def get_indices(self):
+        return np.arange(len(self.dataset))
+
+
+class RandomSampler(Sampler):
+    def get_indices(self):
+        return self._get_rng().permutation(len(self.dataset))
+
+
+class WeightedCategorySampler(Sampler):
+    # draws num_samples indices with replacement, weights maps category -> weight of the whole category;
+    # None gives every category the same total weight, whatever its size
+    def __init__(self, dataset, weights=None, num_samples=None, seed=None):
+        super(WeightedCategorySampler, self).__init__(dataset, seed)
+        self.weights = weights
+        self.num_samples = num_samples
+
+    def get_indices(self):
+        cats = self.dataset.get_categories()
+        unique_cats, cat_ids, counts = np.unique(cats, return_inverse=True, return_counts=True)
+        if self.weights is None:
+            cat_weights = np.ones(len(unique_cats))
+        else:
+            cat_weights = np.array([self.weights.get(cat, 0.0) for cat in unique_cats], dtype=np.float64)
+        p = (cat_weights / counts)[cat_ids]
+        p = p / p.sum()
+        return self._get_rng().choice(len(cats), size=len(self), replace=True, p=p)
+
+    def __len__(self):
+        if self.num_samples is None:
+            return len(self.dataset)
+        return self.num_samples
+
+
+class LocalitySampler(Sampler):
+    # keeps the indices of one item (same objs_dir / point cloud) together, so that the os readahead
+    # and the mesh cache see runs of neighbouring files; only the order of the items is shuffled
+    def __init__(self, dataset, shuffle=True, seed=None):
+        super(LocalitySampler, self).__init__(dataset, seed)
+        self.shuffle = shuffle
+
+    def get_indices(self):
+        item_ids = self.dataset.get_item_ids()
+        unique_items, group_ids = np.unique(item_ids, return_inverse=True)
+        if self.shuffle:
+            group_rank = self._get_rng().permutation(len(unique_items))
+        else:
+            group_rank = np.arange(len(unique_items))
+        return np.lexsort((np.arange(len(item_ids)), group_rank[group_ids]))
+
+
+class DistributedShardSampler(Sampler):
+    # splits the epoch of an inner sampler between world_size ranks; every rank must use the same seed so
+    # the inner orders agree, the epoch is padded by wrapping around so that all shards have the same size
+    def __init__(self, dataset, rank, world_size, sampler=None, seed=0):
+        super(DistributedShardSampler, self).__init__(dataset, seed)
+        assert 0 <= rank < world_size
+        self.rank = rank
+        self.world_size = world_size
+        if sampler is None:
+            sampler = RandomSampler(dataset, seed=seed)
+        self.sampler = sampler
+
+    def set_epoch(self, epoch):
+        super(DistributedShardSampler, self).set_epoch(epoch)
+        self.sampler.set_epoch(epoch)
+
+    def get_indices(self):
+        indices = np.asarray(self.sampler.get_indices(), dtype=np.int64)
+        if len(indices) == 0:
+            return indices
+        total = len(self) * self.world_size
+        indices = np.resize(indices, total)
+        return indices[self.rank:total:self.world_size]
+
+    def __len__(self):
+        return -(-len(self.sampler) // self.world_size)